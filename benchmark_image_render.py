@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import pdfplumber
+from regex_extractor_v02 import render_image, render_page_images, RENDER_DPI, pdf_directory
+
+
+def benchmark_image_render(directory, resolution=RENDER_DPI):
+    """Compares rendering every image region separately with cropping all images from one page render.
+
+    Args:
+        directory: The path to the directory containing PDFs.
+        resolution: The render resolution in DPI.
+    """
+    per_image_time = 0.0
+    page_once_time = 0.0
+    pages = 0
+    images = 0
+
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".pdf"):
+            continue
+        with pdfplumber.open(os.path.join(directory, filename)) as pdf:
+            for page in pdf.pages:
+                page_images = page.images
+                if not page_images:
+                    continue
+                pages += 1
+                images += len(page_images)
+
+                start = time.perf_counter()
+                for img in page_images:
+                    render_image(page, img, resolution)
+                per_image_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                render_page_images(page, page_images, resolution)
+                page_once_time += time.perf_counter() - start
+
+    print(f"{images} images on {pages} pages at {resolution} DPI")
+    print(f"One render per image: {per_image_time:.2f}s")
+    print(f"One render per page:  {page_once_time:.2f}s")
+    if page_once_time:
+        print(f"Speedup: {per_image_time / page_once_time:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark_image_render(sys.argv[1] if len(sys.argv) > 1 else pdf_directory)
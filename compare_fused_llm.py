@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import difflib
+import statistics
+
+# Both modes must reach the model, so the response cache is off
+os.environ["LLM_CACHE_PATH"] = ""
+
+from regex_extractor_v02 import (
+    parse_pdf, fused_rephrase, list_tables_and_rephrase, fused_chain, tabel_chain, rephrase_chain, pdf_directory
+)
+
+
+class UsageRecorder:
+    """Wraps a chain and sums the tokens reported by its responses."""
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.calls = 0
+        self.tokens = 0
+
+    def invoke(self, inputs):
+        response = self.chain.invoke(inputs)
+        self.calls += 1
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            self.tokens += usage["total_tokens"]
+        return response
+
+
+def summarize(name, latencies, recorders):
+    calls = sum(recorder.calls for recorder in recorders)
+    tokens = sum(recorder.tokens for recorder in recorders)
+    p95 = sorted(latencies)[int(0.95 * (len(latencies) - 1))]
+    print(f"{name}: {calls} calls, {tokens} tokens, latency mean {statistics.mean(latencies):.2f}s, "
+          f"p50 {statistics.median(latencies):.2f}s, p95 {p95:.2f}s")
+
+
+def compare_fused_llm(directory, limit=20, show_diffs=3):
+    """Runs the fused and the two-step LLM modes on the texts of sample PDFs.
+
+    Reports the latency and token spend of both modes, how often they agree
+    on table_detected, and the diffs of the least similar outputs.
+
+    Args:
+        directory: The path to the directory containing sample PDFs.
+        limit: The maximum number of PDFs to use.
+        show_diffs: The number of output diffs to print.
+    """
+    texts = []
+    for filename in sorted(os.listdir(directory))[:limit]:
+        if filename.endswith(".pdf"):
+            input_text = parse_pdf(os.path.join(directory, filename))["input_text"]
+            texts.append(input_text["question"])
+            texts += [answer["explanation"] for answer in input_text["answers"] if answer.get("explanation")]
+
+    fused, fused_tabel, fused_rephrase_chain = UsageRecorder(fused_chain), UsageRecorder(tabel_chain), UsageRecorder(rephrase_chain)
+    two_step_tabel, two_step_rephrase = UsageRecorder(tabel_chain), UsageRecorder(rephrase_chain)
+    fused_latencies, two_step_latencies = [], []
+    comparisons = []
+    for text in texts:
+        start = time.perf_counter()
+        fused_result = fused_rephrase(text, fused, fused_tabel, fused_rephrase_chain)
+        fused_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        two_step_result = list_tables_and_rephrase(text, two_step_tabel, two_step_rephrase)
+        two_step_latencies.append(time.perf_counter() - start)
+
+        similarity = difflib.SequenceMatcher(None, fused_result[0] or "", two_step_result[0] or "").ratio()
+        comparisons.append((similarity, text, fused_result, two_step_result))
+
+    print(f"{len(texts)} texts from {directory}")
+    summarize("Fused", fused_latencies, [fused, fused_tabel, fused_rephrase_chain])
+    summarize("Two-step", two_step_latencies, [two_step_tabel, two_step_rephrase])
+    print(f"Fused fallbacks: {fused_tabel.calls}")
+    agreement = sum(fused_result[1] == two_step_result[1] for _, _, fused_result, two_step_result in comparisons)
+    print(f"table_detected agreement: {agreement}/{len(comparisons)}")
+    print(f"Mean output similarity: {statistics.mean(c[0] for c in comparisons):.3f}")
+
+    differing = [comparison for comparison in comparisons if comparison[0] < 1]
+    for similarity, text, fused_result, two_step_result in sorted(differing, key=lambda c: c[0])[:show_diffs]:
+        print(f"\n--- similarity {similarity:.3f}: {text[:60]!r}")
+        diff = difflib.unified_diff(
+            (two_step_result[0] or "").splitlines(), (fused_result[0] or "").splitlines(),
+            "two-step", "fused", lineterm=""
+        )
+        print("\n".join(diff))
+
+
+if __name__ == "__main__":
+    compare_fused_llm(sys.argv[1] if len(sys.argv) > 1 else pdf_directory)
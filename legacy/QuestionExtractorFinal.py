@@ -10,7 +10,7 @@ from docx import Document
 from docx.shared import Inches
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
-output_file = os.path.join(current_dir, "output", "output2.json")
+output_file = os.path.join(current_dir, "output", "output2.jsonl")
 output_docx_file = os.path.join(current_dir, "output", "outputW.docx")
 pdf_directory = os.path.join(current_dir, "pdfs")
 image_dir = os.path.join(current_dir, "images")
@@ -62,20 +62,9 @@ tabel_chain = (
 
 # Function to append JSON to file
 def append_json_to_file(json_object, filename=output_file):
-    try:
-        with open(filename, 'r+') as file:
-            # Load existing data
-            file_data = json.load(file)
-            # Append new data
-            file_data.append(json_object)
-            # Set file's current position at offset
-            file.seek(0)
-            # Convert back to JSON and write
-            json.dump(file_data, file, indent=4)
-    except FileNotFoundError:
-        # If file doesn't exist, create it and add the first item
-        with open(filename, 'w') as file:
-            json.dump([json_object], file, indent=4)
+    # One JSON object per line, so an append never reloads or rewrites the file
+    with open(filename, 'a') as file:
+        file.write(json.dumps(json_object) + "\n")
 
 
 def extract_pdfs(directory, output_file):
@@ -83,7 +72,7 @@ def extract_pdfs(directory, output_file):
 
     Args:
         directory: The path to the directory containing PDFs.
-        output_file: The path to the output JSON file.
+        output_file: The path to the output JSON Lines file.
     """
 
     for filename in os.listdir(directory):
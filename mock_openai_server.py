@@ -0,0 +1,106 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers /v1/chat/completions like the OpenAI API, with its rate limits.
+
+    Requests beyond --rpm in the last minute, and a random --rate-limit-rate
+    share of the others, get a 429 with a Retry-After header. The table,
+    fused and batch prompts get the input texts back as JSON objects without
+    tables; the rephrase prompt gets the input text back.
+    """
+
+    # Keep connections open between requests, as the OpenAI API does
+    protocol_version = "HTTP/1.1"
+    requests = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        time.sleep(server.latency)
+
+        with self.lock:
+            now = time.monotonic()
+            self.requests[:] = [started for started in self.requests if now - started < 60]
+            limited = len(self.requests) >= server.rpm or random.random() < server.rate_limit_rate
+            if not limited:
+                self.requests.append(now)
+        if limited:
+            server.rate_limited += 1
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                           "code": "rate_limit_exceeded"}},
+                           {"retry-after": str(server.retry_after)})
+            return
+
+        system, text = body["messages"][0]["content"], body["messages"][-1]["content"]
+        text = text.split("Use the following text:\n\n", 1)[-1]
+        if "explanations of the answer choices" in system:
+            text = text.split("Use the following explanations:\n\n", 1)[-1]
+            content = json.dumps({choice: {"content": explanation, "table_detected": False}
+                                  for choice, explanation in json.loads(text).items()})
+        elif "rephrased_content" in system:
+            content = json.dumps({"rephrased_content": text, "table_detected": False})
+        elif "table recognition" in system:
+            content = json.dumps({"content": text, "table_detected": False})
+        else:
+            content = text
+        prompt_tokens = sum(len(message["content"]) // 4 + 1 for message in body["messages"])
+        completion_tokens = len(content) // 4 + 1
+        self.send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8000, rpm=60, rate_limit_rate=0.0, retry_after=1, latency=0.2):
+    """Runs an OpenAI-compatible mock server for testing the LLM rate limiter.
+
+    Point the extractor at it with OPENAI_BASE_URL=http://localhost:<port>/v1.
+    """
+    server = ThreadingHTTPServer(("localhost", port), MockOpenAIHandler)
+    server.rpm = rpm
+    server.rate_limit_rate = rate_limit_rate
+    server.retry_after = retry_after
+    server.latency = latency
+    server.rate_limited = 0
+    print(f"Mock OpenAI server on http://localhost:{port}/v1 ({rpm} requests/min)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Rate limited requests: {server.rate_limited}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=serve.__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+    serve(args.port, args.rpm, args.rate_limit_rate, args.retry_after, args.latency)
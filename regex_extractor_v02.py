@@ -1,10 +1,19 @@
 import pdfplumber
+from pdfminer.pdftypes import (
+    LITERALS_ASCII85_DECODE, LITERALS_ASCIIHEX_DECODE, LITERALS_DCT_DECODE, LITERALS_FLATE_DECODE,
+    LITERALS_LZW_DECODE, LITERALS_RUNLENGTH_DECODE, resolve1,
+)
+from PIL import Image
+import numpy as np
 from docx import Document
 import re
 import json
+import io
 from dotenv import load_dotenv
 from langchain.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+import openai
+from langchain_core.messages import AIMessage
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
 import os
@@ -13,12 +22,29 @@ from firebase_admin import credentials, firestore, storage
 from bson import ObjectId
 from datetime import datetime
 import time
-from pymongo import MongoClient
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import queue
+import multiprocessing
+import collections
+import gzip
+import random
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 # output_json = os.path.join(current_dir, "output", "output.json")
 # output_json_with_tables = os.path.join(current_dir, "output", "output_with_tables.json")
+output_jsonl = os.path.join(current_dir, "output", "output.jsonl")
+output_jsonl_with_tables = os.path.join(current_dir, "output", "output_with_tables.jsonl")
 output_docx = os.path.join(current_dir, "output", "output.docx")
 output_docx_with_tables = os.path.join(current_dir, "output", "output_with_tables.docx")
 pdf_directory = os.path.join(current_dir, "pdfs", "with table")
@@ -34,23 +60,155 @@ MONGO_URI = os.getenv('MONGO_URI')
 
 BANK_NAME = "CUSTOM"
 
-# Initialize Firebase
-cred = credentials.Certificate(firebase_credentials)
-firebase_admin.initialize_app(cred,
-                              {
-        'storageBucket': FIRESTORE_BUCKET
-    })
-
-# Initialize Storage
-bucket = storage.bucket()
-
-# MongoDB setup
-client = MongoClient(MONGO_URI)
-db = client['amc-site2']  # Database name
-collection = db['questions']  # Collection name
+# Number of worker processes used to parse PDFs (1 = serial)
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 1))
+
+# Run extraction, LLM calls, uploads and writes as concurrent stages connected by
+# queues of at most PIPELINE_QUEUE_SIZE PDFs; LLM_WORKERS threads rephrase PDFs
+PIPELINE = os.getenv('PIPELINE', 'false').lower() == 'true'
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', 4))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 8))
+
+# Send all LLM requests of a document concurrently, at most LLM_CONCURRENCY at a time
+ASYNC_LLM = os.getenv('ASYNC_LLM', 'false').lower() == 'true'
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 8))
+
+# Detect tables and rephrase in one JSON-mode call per text; the two-call path is used
+# when the response does not validate
+FUSED_LLM = os.getenv('FUSED_LLM', 'false').lower() == 'true'
+
+# Rephrase the raw text while tabel_chain runs, and keep that result when the table
+# chain returns the text unchanged
+SPECULATIVE_REPHRASE = os.getenv('SPECULATIVE_REPHRASE', 'false').lower() == 'true'
+if FUSED_LLM and SPECULATIVE_REPHRASE:
+    # The fused call has no separate rephrase to start early, so speculation would never run
+    raise ValueError("FUSED_LLM and SPECULATIVE_REPHRASE cannot be combined; enable one of them")
+
+# Send the explanations of a document in JSON requests of at most BATCH_TOKEN_BUDGET
+# input tokens; explanations missing from a batch response are sent one by one
+BATCH_EXPLANATIONS = os.getenv('BATCH_EXPLANATIONS', 'false').lower() == 'true'
+BATCH_TOKEN_BUDGET = int(os.getenv('BATCH_TOKEN_BUDGET', 2000))
+
+# Client-side limits shared by all LLM calls: requests and tokens per minute, and a
+# concurrency limit that is halved on every 429 and grows back after successful calls.
+# Rate limited calls are retried LLM_RATE_RETRIES times after Retry-After or a backoff
+LLM_RATE_LIMIT = os.getenv('LLM_RATE_LIMIT', 'false').lower() == 'true'
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 30000))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+LLM_RATE_RETRIES = int(os.getenv('LLM_RATE_RETRIES', 5))
+LLM_BACKOFF_SECONDS = float(os.getenv('LLM_BACKOFF_SECONDS', 1))
+
+# On-disk cache of LLM responses (set LLM_CACHE_PATH to an empty string to disable)
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(current_dir, "output", "llm_cache.sqlite"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 100000))
+LLM_CACHE_MAX_AGE_DAYS = int(os.getenv('LLM_CACHE_MAX_AGE_DAYS', 30))
+
+# Firebase is set up on first use, so the module can be imported without credentials
+bucket = None
+bucket_lock = threading.Lock()
+
+def get_bucket():
+    """Initializes Firebase on first use and returns the Storage bucket."""
+    global bucket
+    with bucket_lock:
+        if bucket is None:
+            # Initialize Firebase
+            cred = credentials.Certificate(firebase_credentials)
+            firebase_admin.initialize_app(cred,
+                                          {
+                    'storageBucket': FIRESTORE_BUCKET
+                })
+
+            # Initialize Storage
+            bucket = storage.bucket()
+    return bucket
+
+# MongoDB is set up on first use, so the module can be imported without a server
+collection = None
+collection_lock = threading.Lock()
+
+def get_collection():
+    """Connects to MongoDB on first use and returns the questions collection."""
+    global collection
+    with collection_lock:
+        if collection is None:
+            # MongoDB setup
+            client = MongoClient(MONGO_URI)
+            db = client['amc-site2']  # Database name
+            collection = db['questions']  # Collection name
+    return collection
+
+# Records are inserted in batches of MONGO_BATCH_SIZE, or every MONGO_FLUSH_SECONDS
+MONGO_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', 100))
+MONGO_FLUSH_SECONDS = float(os.getenv('MONGO_FLUSH_SECONDS', 5))
+
+# Derive the _ids from (bank, PDF content hash, question index) and upsert the records,
+# so reprocessing a PDF updates its question in place instead of inserting a duplicate
+MONGO_UPSERT = os.getenv('MONGO_UPSERT', 'false').lower() == 'true'
+
+# Also write every record as a line of output/output*.jsonl, optionally compressed ("gzip" or "zstd")
+OUTPUT_JSONL = os.getenv('OUTPUT_JSONL', 'false').lower() == 'true'
+OUTPUT_JSONL_COMPRESSION = os.getenv('OUTPUT_JSONL_COMPRESSION', '')
+
+# Skip the table LLM call for texts the local geometric detector rules out
+TABLE_PREFILTER = os.getenv('TABLE_PREFILTER', 'false').lower() == 'true'
+TABLE_PREFILTER_THRESHOLD = float(os.getenv('TABLE_PREFILTER_THRESHOLD', 0.5))
+
+# Build markdown tables from the PDF geometry; tabel_chain only runs for tables below the confidence
+TABLE_ENGINE = os.getenv('TABLE_ENGINE', 'false').lower() == 'true'
+TABLE_ENGINE_MIN_CONFIDENCE = float(os.getenv('TABLE_ENGINE_MIN_CONFIDENCE', 0.8))
+
+# Index of uploaded images by content hash, so repeated images reuse their blob
+# (set IMAGE_INDEX_PATH to an empty string to only deduplicate within a run)
+IMAGE_INDEX_PATH = os.getenv('IMAGE_INDEX_PATH', os.path.join(current_dir, "output", "image_index.sqlite"))
+
+# Manifest of processed PDFs by content hash; reruns skip stored files and resume the others
+# (set MANIFEST_PATH to an empty string to process every PDF)
+MANIFEST_PATH = os.getenv('MANIFEST_PATH', os.path.join(current_dir, "output", "manifest.sqlite"))
+
+# Images are uploaded by UPLOAD_WORKERS threads while the document is processed;
+# failed uploads are retried with exponential backoff
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 8))
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', 3))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv('UPLOAD_BACKOFF_SECONDS', 1))
+
+# Images are kept in memory; set SAVE_IMAGES=true to also write them to images/ for debugging
+SAVE_IMAGES = os.getenv('SAVE_IMAGES', 'false').lower() == 'true'
+
+# "render" crops each image from a render of the page; "embedded" passes JPEG streams
+# through and decodes the other image streams, falling back to the render
+IMAGE_EXTRACTION = os.getenv('IMAGE_EXTRACTION', 'render')
+# Render each page once at RENDER_DPI and crop all its images from that bitmap
+# (RENDER_PAGE_ONCE=false renders every image region separately)
+RENDER_PAGE_ONCE = os.getenv('RENDER_PAGE_ONCE', 'true').lower() == 'true'
+RENDER_DPI = int(os.getenv('RENDER_DPI', 72))
+
+# Skip decorative images: smaller than IMAGE_MIN_AREA (pt²), more elongated than
+# IMAGE_MAX_ASPECT_RATIO, or close to a perceptual hash of DECORATIVE_HASHES_PATH
+IMAGE_FILTER = os.getenv('IMAGE_FILTER', 'false').lower() == 'true'
+IMAGE_MIN_AREA = float(os.getenv('IMAGE_MIN_AREA', 400))
+IMAGE_MAX_ASPECT_RATIO = float(os.getenv('IMAGE_MAX_ASPECT_RATIO', 10))
+DECORATIVE_HASHES_PATH = os.getenv('DECORATIVE_HASHES_PATH', os.path.join(current_dir, "output", "decorative_hashes.json"))
+DECORATIVE_HASH_DISTANCE = int(os.getenv('DECORATIVE_HASH_DISTANCE', 4))
+
+# Downscale and re-encode images before they are uploaded and added to the DOCX
+IMAGE_OPTIMIZE = os.getenv('IMAGE_OPTIMIZE', 'false').lower() == 'true'
+IMAGE_MAX_WIDTH = int(os.getenv('IMAGE_MAX_WIDTH', 1600))
+IMAGE_MAX_HEIGHT = int(os.getenv('IMAGE_MAX_HEIGHT', 1600))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'png')  # png, webp or jpeg
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+IMAGE_LOSSLESS_ONLY = os.getenv('IMAGE_LOSSLESS_ONLY', 'false').lower() == 'true'
+
+# The output documents are saved every DOCX_CHECKPOINT_EVERY questions and at the end of the run
+DOCX_CHECKPOINT_EVERY = int(os.getenv('DOCX_CHECKPOINT_EVERY', 50))
 
 # Create a ChatOpenAI model
-model = ChatOpenAI(model="gpt-4o")
+if LLM_RATE_LIMIT:
+    # Rate limited and transient errors are retried by RateLimitedChain, not by the client
+    model = ChatOpenAI(model="gpt-4o", max_retries=0)
+else:
+    model = ChatOpenAI(model="gpt-4o")
 
 rephraser_prompt_template = ChatPromptTemplate.from_messages([
     ("system", """
@@ -116,162 +274,875 @@ tabel_chain = (
     table_recognizer_prompt_template | model
 )
 
+# Define the output structure of the fused chain
+class RephrasedText(BaseModel):
+    rephrased_content: str = Field(description="The rephrased text, with any tables formatted in markdown")
+    table_detected: bool = Field(description="Whether the text contains a table")
+
+fused_prompt_template = ChatPromptTemplate.from_messages([
+    ("system", """
+        You are a table recognition and formatting specialist and an expert Rephraser. Your task is to format any tables found in the provided text in markdown, and to rephrase the rest of the text while ensuring that all factual data, context, and meaning are strictly preserved.
+
+        **Guidelines:**
+        - **Accuracy First:** Ensure all tables are correctly identified and represented in markdown format without any data loss. Keep the rows and columns of each table intact.
+        - **Clarity:** Ensure the rephrased text is clear and easy to understand.
+        - **Conciseness:** Reduce unnecessary words or redundancy without altering the meaning.
+        - **Maintain Meaning:** Be especially careful that the rephrased version does not change the intent or tone of the original text. Avoid adding or omitting any details.
+
+        **Output Specification:**
+        Return a JSON object with:
+          - `rephrased_content`: The rephrased text, with the tables formatted in markdown and followed by two newlines.
+          - `table_detected`: `true` if one or more tables were found, `false` otherwise.
+
+        **Note:** Use only 'true' or 'false' for the 'table_detected' field. Always provide the result in JSON format.
+    """),
+    ("human", "Use the following text:\n\n{text}")
+])
+
+fused_chain = (
+    fused_prompt_template | model.bind(response_format={"type": "json_object"})
+)
+
+batch_prompt_template = ChatPromptTemplate.from_messages([
+    ("system", """
+        You are a table recognition and formatting specialist and an expert Rephraser. You receive the explanations of the answer choices of one question, as a JSON object mapping each choice number to its explanation. For every explanation, format any tables it contains in markdown and rephrase the rest of the text while ensuring that all factual data, context, and meaning are strictly preserved.
+
+        **Guidelines:**
+        - **Accuracy First:** Ensure all tables are correctly identified and represented in markdown format without any data loss.
+        - **Clarity:** Ensure the rephrased text is clear and easy to understand.
+        - **Maintain Meaning:** Be especially careful that the rephrased version does not change the intent or tone of the original text. Avoid adding or omitting any details.
+        - **Independence:** Rephrase every explanation on its own; never move content between choices.
+
+        **Output Specification:**
+        Return a JSON object with exactly the same keys as the input. The value of every key is an object with:
+          - `content`: The rephrased explanation, with the tables formatted in markdown and followed by two newlines.
+          - `table_detected`: `true` if the explanation contains one or more tables, `false` otherwise.
+
+        **Example:**
+        Input: {{"1": "The rate is higher.", "3": "The rate is lower."}}
+        Output: {{"1": {{"content": "The rate is greater.", "table_detected": false}}, "3": {{"content": "The rate is smaller.", "table_detected": false}}}}
+    """),
+    ("human", "Use the following explanations:\n\n{text}")
+])
+
+batch_chain = (
+    batch_prompt_template | model.bind(response_format={"type": "json_object"})
+)
+
+def estimate_tokens(text):
+    # About four characters per token for English text
+    return len(text) // 4 + 1
+
+def backoff_delay(attempt, backoff, max_delay=60):
+    """Exponential backoff with jitter."""
+    return min(max_delay, backoff * 2 ** attempt + random.uniform(0, backoff))
+
+def is_rate_limit_error(error):
+    return isinstance(error, openai.RateLimitError) or getattr(error, "status_code", None) == 429
+
+def is_transient_error(error):
+    """True for the errors the OpenAI client retries itself: timeouts, lost connections and server errors."""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code in (408, 409) or (status_code or 0) >= 500
+
+def retry_after_seconds(error):
+    """Returns the delay the server asked for in a rate limit response, or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # An HTTP date; fall back to the backoff
+        pass
+    return None
+
+class RateLimiter:
+    """Client-side rate limiter shared by all LLM calls of the process.
+
+    Token buckets cap the requests and tokens per minute (0 disables a
+    bucket). The number of calls in flight is capped by a concurrency limit
+    that is halved on every rate limit response and raised by one after
+    increase_after successful calls in a row. A Retry-After pauses all calls.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=30000, max_concurrency=8, increase_after=10):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.increase_after = increase_after
+        self.concurrency = max_concurrency
+        self.request_bucket = float(requests_per_minute)
+        self.token_bucket = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.successes = 0
+        self.calls = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_bucket = min(self.requests_per_minute, self.request_bucket + elapsed * self.requests_per_minute / 60)
+        self.token_bucket = min(self.tokens_per_minute, self.token_bucket + elapsed * self.tokens_per_minute / 60)
+
+    def try_acquire(self, tokens):
+        """Starts a call of about tokens tokens if the limits allow it.
+
+        Returns 0 if the call may start, else the seconds to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= self.concurrency:
+                return 0.05
+            wait = 0.0
+            if self.requests_per_minute and self.request_bucket < 1:
+                wait = (1 - self.request_bucket) * 60 / self.requests_per_minute
+            if self.tokens_per_minute:
+                # A call larger than the bucket waits for a full bucket
+                tokens = min(tokens, self.tokens_per_minute)
+                if self.token_bucket < tokens:
+                    wait = max(wait, (tokens - self.token_bucket) * 60 / self.tokens_per_minute)
+            if wait:
+                return wait
+            self.request_bucket -= 1
+            self.token_bucket -= tokens
+            self.in_flight += 1
+            self.calls += 1
+            return 0
+
+    def acquire(self, tokens):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, estimated_tokens=0, used_tokens=None):
+        """Ends a call, charging the tokens it used beyond the estimate."""
+        with self.lock:
+            self.in_flight -= 1
+            if used_tokens is not None and self.tokens_per_minute:
+                self.token_bucket -= used_tokens - min(estimated_tokens, self.tokens_per_minute)
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.increase_after and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+
+    def on_rate_limit(self, retry_after=None):
+        with self.lock:
+            self.rate_limited += 1
+            self.successes = 0
+            self.concurrency = max(1, self.concurrency // 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def stats(self):
+        return {"calls": self.calls, "rate_limited": self.rate_limited, "concurrency": self.concurrency}
+
+class RateLimitedChain:
+    """Wraps a prompt | model chain so every call goes through a RateLimiter.
+
+    Rate limit responses are retried up to retries times, after their
+    Retry-After or an exponential backoff with jitter. Timeouts, lost
+    connections and server errors are retried the same way, without
+    lowering the concurrency limit.
+    """
+
+    def __init__(self, chain, limiter, prompt_template, retries=5, backoff=1.0):
+        self.chain = chain
+        self.limiter = limiter
+        self.prompt_tokens = estimate_tokens(prompt_text(prompt_template))
+        self.retries = retries
+        self.backoff = backoff
+
+    def estimate(self, inputs):
+        # The response is about as long as the input text
+        return self.prompt_tokens + 2 * estimate_tokens(inputs["text"])
+
+    def retry_delay(self, error, attempt):
+        if attempt == self.retries:
+            raise error
+        if is_rate_limit_error(error):
+            retry_after = retry_after_seconds(error)
+            self.limiter.on_rate_limit(retry_after)
+            delay = retry_after or backoff_delay(attempt, self.backoff)
+            print(f"Rate limited: {error}. Retrying in {delay:.1f}s... {attempt + 1}/{self.retries}")
+        elif is_transient_error(error):
+            delay = backoff_delay(attempt, self.backoff)
+            print(f"LLM call failed: {error}. Retrying in {delay:.1f}s... {attempt + 1}/{self.retries}")
+        else:
+            raise error
+        return delay
+
+    def done(self, tokens, response):
+        usage = getattr(response, "usage_metadata", None)
+        self.limiter.release(tokens, usage["total_tokens"] if usage else None)
+        self.limiter.on_success()
+        return response
+
+    def invoke(self, inputs):
+        tokens = self.estimate(inputs)
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(tokens)
+            try:
+                response = self.chain.invoke(inputs)
+            except Exception as e:
+                self.limiter.release()
+                time.sleep(self.retry_delay(e, attempt))
+                continue
+            return self.done(tokens, response)
+
+    async def ainvoke(self, inputs):
+        tokens = self.estimate(inputs)
+        for attempt in range(self.retries + 1):
+            await self.limiter.aacquire(tokens)
+            try:
+                response = await self.chain.ainvoke(inputs)
+            except Exception as e:
+                self.limiter.release()
+                await asyncio.sleep(self.retry_delay(e, attempt))
+                continue
+            return self.done(tokens, response)
+
+class LLMCache:
+    """On-disk cache of LLM responses, keyed by a hash of the model, prompt and input text."""
+
+    def __init__(self, path, max_entries=100000, max_age_days=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connection(self):
+        # The database is opened on first use, not when the module is imported
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def make_key(model_name, prompt_text, text):
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_text, text):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection().execute(
+                "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        with self.lock:
+            self.connection().execute(
+                "INSERT OR REPLACE INTO responses (key, content, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, content, now, now),
+            )
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now):
+        # Drop expired entries, then the least recently used ones above max_entries
+        self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,))
+        self.conn.execute("""
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+def prompt_text(prompt_template):
+    """Returns the raw text of all messages of a prompt template, used in the cache key."""
+    return json.dumps([
+        [message.__class__.__name__, message.prompt.template]
+        for message in prompt_template.messages
+    ])
+
+class CachedChain:
+    """Wraps a prompt | model chain and serves repeated inputs from an LLMCache.
+
+    Only responses accepted by validate are stored, so a malformed response
+    is not replayed on retry.
+    """
+
+    def __init__(self, chain, cache, prompt_template, model_name, validate=None):
+        self.chain = chain
+        self.cache = cache
+        self.prompt_text = prompt_text(prompt_template)
+        self.model_name = model_name
+        self.validate = validate
+
+    def cache_key(self, inputs):
+        return self.cache.make_key(self.model_name, self.prompt_text, inputs["text"])
+
+    def store(self, key, response):
+        if self.validate is None or self.validate(response.content):
+            self.cache.put(key, response.content)
+
+    def invoke(self, inputs):
+        key = self.cache_key(inputs)
+        content = self.cache.get(key)
+        if content is not None:
+            return AIMessage(content=content)
+        response = self.chain.invoke(inputs)
+        self.store(key, response)
+        return response
+
+    async def ainvoke(self, inputs):
+        key = self.cache_key(inputs)
+        content = self.cache.get(key)
+        if content is not None:
+            return AIMessage(content=content)
+        response = await self.chain.ainvoke(inputs)
+        self.store(key, response)
+        return response
+
+def parse_fused_response(content):
+    """Returns the RephrasedText of a fused chain response, or None if it does not validate."""
+    try:
+        data = json.loads(content.strip('```json').strip('```'))
+        return RephrasedText(**data)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return None
+
+def is_valid_fused_response(content):
+    return parse_fused_response(content) is not None
+
+def parse_batch_response(content):
+    """Returns the {choice: (content, table_detected)} items of a batch response that validate."""
+    try:
+        data = json.loads(content.strip('```json').strip('```'))
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    items = {}
+    for choice, item in data.items():
+        if (isinstance(item, dict) and isinstance(item.get('content'), str)
+                and isinstance(item.get('table_detected'), bool)):
+            items[choice] = (item['content'], item['table_detected'])
+    return items
+
+def is_valid_batch_response(content):
+    return bool(parse_batch_response(content))
+
+def is_valid_table_response(content):
+    try:
+        parsed_data = json.loads(content.strip('```json').strip('```'))
+        return 'content' in parsed_data and 'table_detected' in parsed_data
+    except (json.JSONDecodeError, TypeError):
+        return False
+
+# Rate limits apply to the calls that miss the cache
+rate_limiter = None
+if LLM_RATE_LIMIT:
+    rate_limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY)
+    rephrase_chain = RateLimitedChain(rephrase_chain, rate_limiter, rephraser_prompt_template,
+                                      LLM_RATE_RETRIES, LLM_BACKOFF_SECONDS)
+    fused_chain = RateLimitedChain(fused_chain, rate_limiter, fused_prompt_template,
+                                   LLM_RATE_RETRIES, LLM_BACKOFF_SECONDS)
+    batch_chain = RateLimitedChain(batch_chain, rate_limiter, batch_prompt_template,
+                                   LLM_RATE_RETRIES, LLM_BACKOFF_SECONDS)
+    tabel_chain = RateLimitedChain(tabel_chain, rate_limiter, table_recognizer_prompt_template,
+                                   LLM_RATE_RETRIES, LLM_BACKOFF_SECONDS)
+
+llm_cache = None
+if LLM_CACHE_PATH:
+    llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_MAX_AGE_DAYS)
+    rephrase_chain = CachedChain(rephrase_chain, llm_cache, rephraser_prompt_template, model.model_name)
+    tabel_chain = CachedChain(tabel_chain, llm_cache, table_recognizer_prompt_template, model.model_name,
+                              validate=is_valid_table_response)
+    fused_chain = CachedChain(fused_chain, llm_cache, fused_prompt_template, model.model_name,
+                              validate=is_valid_fused_response)
+    batch_chain = CachedChain(batch_chain, llm_cache, batch_prompt_template, model.model_name,
+                              validate=is_valid_batch_response)
+
 # Function to generate ObjectId
 def generate_object_id():
     return ObjectId()
 
+# Function to generate an ObjectId that is the same for the same key parts
+def generate_stable_object_id(*parts):
+    key = ":".join(str(part) for part in parts)
+    return ObjectId(hashlib.sha256(key.encode("utf-8")).digest()[:12])
+
 # Function to get the current timestamp
 def get_current_timestamp():
     return datetime.utcnow()
 
+class NormalizationRule:
+    """A pattern to remove or replace while normalizing the page text.
+
+    The replacement is a string or a function of the match. Group names must
+    be unique across the rules of a pipeline, and flags must be inline.
+    """
+
+    def __init__(self, name, pattern, replacement=""):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+
+class NormalizationPipeline:
+    """Applies a list of rules to the text in a single pass.
+
+    The rules are compiled into one alternation, so the text is scanned once
+    and the output is built once. When cut_after is given, everything up to
+    and including its last occurrence is dropped first. Hits are counted per rule.
+    """
+
+    def __init__(self, rules, cut_after=None, strip=True):
+        self.rules = {rule.name: rule for rule in rules}
+        self.cut_after = cut_after
+        self.strip = strip
+        self.scanner = None
+        if rules:
+            self.scanner = re.compile("|".join(f"(?P<{rule.name}>{rule.pattern})" for rule in rules))
+        self.hits = dict.fromkeys(["cut_after"] + list(self.rules), 0)
+
+    def normalize(self, text, hits=None):
+        hits = self.hits if hits is None else hits
+        if self.cut_after:
+            pos = text.rfind(self.cut_after)
+            if pos != -1:
+                hits["cut_after"] = hits.get("cut_after", 0) + 1
+                text = text[pos + len(self.cut_after):]
+
+        pieces = []
+        last_end = 0
+        for match in self.scanner.finditer(text) if self.scanner else ():
+            rule = self.rules[match.lastgroup]
+            hits[rule.name] = hits.get(rule.name, 0) + 1
+            pieces.append(text[last_end:match.start()])
+            pieces.append(rule.replacement(match) if callable(rule.replacement) else rule.replacement)
+            last_end = match.end()
+        pieces.append(text[last_end:])
+        text = "".join(pieces)
+        return text.strip() if self.strip else text
+
+# Phrase that ends the quiz navigation above the question
+QUESTION_START_PHRASE = "Answered Review question Quiz-summary"
+
+CONSECUTIVE_DUPLICATES_RULE = NormalizationRule(
+    "consecutive_duplicates", r"(?i:\b(?P<word>\w+)\s+(?P=word)\b)", lambda match: match.group("word"))
+WEB_LINKS_RULE = NormalizationRule("web_links", r"http\S+|www\S+")
+
+# Page text normalization used before parsing: drop the navigation above the
+# question, consecutive duplicate words and web links
+text_normalizer = NormalizationPipeline(
+    [CONSECUTIVE_DUPLICATES_RULE, WEB_LINKS_RULE], cut_after=QUESTION_START_PHRASE)
+
+consecutive_duplicates_normalizer = NormalizationPipeline([CONSECUTIVE_DUPLICATES_RULE], strip=False)
+web_links_normalizer = NormalizationPipeline([WEB_LINKS_RULE])
+content_above_question_normalizer = NormalizationPipeline([], cut_after=QUESTION_START_PHRASE)
+
 def remove_consecutive_duplicates(text):
-    def replace_func(match):
-        return match.group(1)
-    
-    pattern = r'\b(\w+)\s+\1\b'
-    return re.sub(pattern, replace_func, text, flags=re.IGNORECASE)
+    return consecutive_duplicates_normalizer.normalize(text)
 
 def remove_web_links(text):
     # Remove web links
-    text = re.sub(r'http\S+|www\S+', '', text)
-    
-    return text.strip()
+    return web_links_normalizer.normalize(text)
 
 def remove_content_above_question(text):
     # Remove all parts above and including the specific phrase
-    phrase = "Answered Review question Quiz-summary"
-    text = re.sub(rf'.*?{re.escape(phrase)}', '', text, flags=re.DOTALL)
+    return content_above_question_normalizer.normalize(text)
+
+# Patterns used by parse_question_data, compiled once at module load
+POINTS_RE = re.compile(r"(\d+)\s+point\(s\)")
+QUESTION_RE = re.compile(r"\d+\.\s*Question\s*(.*?)(?=\n\s*\d+\.\s)", re.DOTALL)
+# The first CORRECT/INCORRECT line ends the options block
+OPTIONS_END_RE = re.compile(r"\n\s*(?:CORRECT|INCORRECT)")
+OPTION_BOUNDARY_RE = re.compile(r"\n\s*\d\.")
+# Options are only searched up to endpos, where \Z matches
+OPTION_RE = re.compile(r"(\d\.\s.*?)(?=\n\s*\d\.|\Z)", re.DOTALL)
+CHOICE_RE = re.compile(r"(\d+)\.\s*(.*)")
+CHOICE_MARKS_RE = re.compile(r"[✔]|\s*[\uF00D]")
+JUSTIFICATION_RE = re.compile(r"(CORRECT|INCORRECT)\s?(.*)", re.DOTALL)
+CORRECT_ANSWER_RE = re.compile(r'The correct answer is (\d(?: & \d)*)')
+CORRECT_CHOICE_RE = re.compile(r'The correct answer is \d\.\s*(.*?)\s*(?=\(Choice|\Z)', re.DOTALL)
+CHOICE_JUSTIFICATION_RE = re.compile(r"\(Choice[s]? (\d(?: & \d)*)\) (.*?)(?=\(Choice|\Z)", re.DOTALL)
+
+def parse_question_data(text):
+    """Extracts the question, its options and their explanations from the page text.
+
+    Walks the text once from left to right, keeping the spans of the question,
+    the options and the CORRECT/INCORRECT block instead of slicing and
+    re-searching the text. Option text is never used as a pattern, so options
+    containing regex characters are handled. Returns
+    {"question": ..., "answers": [{"text", "isCorrect", "explanation"}, ...]}.
+    """
+    # The points are removed from the extracted spans (kept as a check for future use)
+    has_points = POINTS_RE.search(text) is not None
 
-    return text.strip()
+    def clean(span):
+        return POINTS_RE.sub('', span) if has_points else span
 
-def extract_question_data(text):
-    points_pattern = r"(\d+)\s+point\(s\)"
-    
-    # Find the points (Note: Removed points from final output, but kept extraction for future use)
-    match_points = re.search(points_pattern, text)
-    if match_points:
-        allocated_points = match_points.group(1)
-        text = re.sub(points_pattern, '', text).strip()
-
-    # Regex to capture the question after the question number (e.g., "18. Question")
-    question_pattern = r"\d+\.\s*Question\s*(.*?)(?=\n\s*\d+\.\s)"
-    question_match = re.search(question_pattern, text, re.DOTALL)
-    
+    pos = 0
     question_text = ""
+    question_match = QUESTION_RE.search(text)
     if question_match:
-        question_text = question_match.group(1).strip()
-        text = text[question_match.end():]  # Remove the extracted question from the text
-
-    # Regex to capture the options (answers)
-    options_pattern = r"(\d\.\s.*?)(?=\n\s*\d\.|\n\s*(?:CORRECT|INCORRECT))"
-    all_options = re.findall(options_pattern, text, re.DOTALL)
+        question_text = clean(question_match.group(1)).strip()
+        pos = question_match.end()
+
+    # The options block ends at the first CORRECT/INCORRECT line. Without one,
+    # it ends at the last option boundary, as the last option has no terminator.
+    options_end_match = OPTIONS_END_RE.search(text, pos)
+    if options_end_match:
+        options_end = options_end_match.start()
+    else:
+        options_end = pos
+        for boundary_match in OPTION_BOUNDARY_RE.finditer(text, pos):
+            options_end = boundary_match.start()
 
-    # Prepare a list for storing answers in the required format
     answers = []
-
-    for option in all_options:
+    for option_match in OPTION_RE.finditer(text, pos, options_end):
         # Capture the choice number and the choice text
-        match = re.match(r"(\d+)\.\s*(.*)", option)
+        match = CHOICE_RE.match(option_match.group(1))
         if match:
-            choice_number = match.group(1)
-            choice_text = match.group(2)
             # Remove special characters like ✔ and 
-            choice_text = re.sub(r"[✔]", "", choice_text).strip()
-            choice_text  = re.sub(r"\s*[\uF00D]", "", choice_text).strip()
-            # Add the choice to the answers list with a placeholder for isCorrect and explanation
+            choice_text = CHOICE_MARKS_RE.sub("", clean(match.group(2))).strip()
             answers.append({
-                "text": f"{choice_number} {choice_text}",  # Add the choice text
-                "isCorrect": False,  # This will be updated later
-                "explanation": ""    # Will add justifications later
+                "number": match.group(1),
+                "text": choice_text,
             })
+        pos = option_match.end()
 
-    if all_options:
-        last_option_match = re.search(all_options[-1], text, re.DOTALL)
-        if last_option_match:
-            text = text[last_option_match.end():]
-
-    # Regex to capture the justification/explanation
-    justification_pattern = r"(CORRECT|INCORRECT)\s?(.*)"
-    justification_match = re.search(justification_pattern, text, re.DOTALL)
-    
     justification_text = ""
+    justification_match = JUSTIFICATION_RE.search(text, pos)
     if justification_match:
-        justification_text = justification_match.group(2).strip()
-        text = text[justification_match.end():]  # Remove the extracted justification from the text
-
-    # print(justification_text)
+        justification_text = clean(justification_match.group(2)).strip()
 
     # Extract the correct answer number
-    correct_answer_match = re.search(r'The correct answer is (\d(?: & \d)*)', justification_text)
-    if correct_answer_match:
-        correct_answer = correct_answer_match.group(1)
-    else:
-        correct_answer = None
-
-    # print("-------------")
-    # print(correct_answer)
+    correct_answer_match = CORRECT_ANSWER_RE.search(justification_text)
+    correct_answer = correct_answer_match.group(1) if correct_answer_match else None
 
     # Collect justifications
     formatted_justifications = {}
 
-    # Pattern to match "Choice X" or "Choice X & Y"
-    pattern = re.compile(r"\(Choice[s]? (\d(?: & \d)*)\) (.*?)(?=\(Choice|\Z)", re.DOTALL)
-
-    # Insert the correct choice justification
-    correct_choice_pattern = re.compile(r'The correct answer is \d\.\s*(.*?)\s*(?=\(Choice|\Z)', re.DOTALL)
-    correct_justification_match = correct_choice_pattern.search(justification_text)
-    
+    correct_justification_match = CORRECT_CHOICE_RE.search(justification_text)
     if correct_justification_match and correct_answer:
-        correct_justification = correct_justification_match.group(1).strip().replace('\n', ' ')
-        formatted_justifications[f"Choice {correct_answer}"]= correct_justification
+        formatted_justifications[f"Choice {correct_answer}"] = correct_justification_match.group(1).strip().replace('\n', ' ')
 
-    # Extract and format other justifications
-    for match in pattern.finditer(justification_text):
-        choices = match.group(1)
+    for match in CHOICE_JUSTIFICATION_RE.finditer(justification_text):
         justification = match.group(2).strip().replace('\n', ' ')
-        if "&" in choices or "," in choices:
-            # Handle multiple choices case, replacing "&" and "and" with commas and splitting by ","
-            choices = choices.replace("&", ",").replace("and", ",").strip()
-            
-            # Loop through each choice and assign the same justification
-            for choice in choices.split(','):
-                choice = choice.strip()
-                formatted_justifications[f"Choice {choice}"] = justification
-        else:
-            # General case for a single choice
-            formatted_justifications[f"Choice {choices}"] = justification
-
-    # print("-------------")
-    # print(json.dumps(formatted_justifications, indent=4))
-
-    # Now update the answers list with the correct answers and justifications
-    for answer in answers:
-        # print("-------------")
-        # print(answer)
-        # Extract choice number safely by checking if it starts with a digit
-        match = re.search(r"(\d+)", answer["text"])
-        if match:
-            choice_number = match.group(1)  # Extract choice number
-            # print("-------------")
-            # print(choice_number)
-            answer["isCorrect"] = choice_number == correct_answer  # Mark correct answer
-            answer["explanation"] = formatted_justifications.get(f"Choice {choice_number}", "")  # Add explanation if exists
-            answer["text"] = re.sub(r"^\d+\s+", "", answer["text"])
-
-    # Return the data in the required format
-    data = {
+        # "Choices 2 & 3" assigns the same justification to every listed choice
+        for choice in match.group(1).split("&"):
+            formatted_justifications[f"Choice {choice.strip()}"] = justification
+
+    return {
         "question": question_text,
         "answers": [
             {
                 "text": answer["text"],
-                "isCorrect": answer["isCorrect"],
-                "explanation": answer["explanation"],
+                "isCorrect": answer["number"] == correct_answer,
+                "explanation": formatted_justifications.get(f"Choice {answer['number']}", ""),
             }
             for answer in answers
         ],
     }
 
-    return data
+class TableDetector:
+    """Finds table-like rows on a page from pdfplumber word positions.
+
+    Words are grouped into lines by their top. A line whose word gaps split it
+    into two or more columns is a row candidate, and a table shows up as a run
+    of such lines whose column starts line up. A run is scored by its length
+    (up to min_rows) times the mean column alignment; rows of runs scoring at
+    least threshold are table candidates. A page without candidates definitely
+    has no table.
+    """
+
+    def __init__(self, threshold=0.5, min_rows=3, line_tolerance=3, align_tolerance=3, gap_ratio=2.0):
+        self.threshold = threshold
+        self.min_rows = min_rows
+        self.line_tolerance = line_tolerance
+        self.align_tolerance = align_tolerance
+        self.gap_ratio = gap_ratio
+
+    def lines(self, words):
+        lines = []
+        for word in sorted(words, key=lambda word: (word["top"], word["x0"])):
+            if lines and word["top"] - lines[-1][0]["top"] <= self.line_tolerance:
+                lines[-1].append(word)
+            else:
+                lines.append([word])
+        return [sorted(line, key=lambda word: word["x0"]) for line in lines]
+
+    def column_starts(self, line):
+        x0 = np.array([word["x0"] for word in line])
+        x1 = np.array([word["x1"] for word in line])
+        char_width = np.median((x1 - x0) / np.array([max(len(word["text"]), 1) for word in line]))
+        # A gap much wider than a character separates two columns
+        gaps = x0[1:] - x1[:-1]
+        return np.concatenate((x0[:1], x0[1:][gaps > self.gap_ratio * char_width]))
+
+    def alignment(self, starts, previous_starts):
+        # Fraction of column starts within align_tolerance of a column start of the previous line
+        distances = np.abs(starts[:, None] - previous_starts[None, :]).min(axis=1)
+        return float(np.mean(distances <= self.align_tolerance))
+
+    def score_runs(self, words):
+        """Returns (score, [lines]) for every run of aligned multi-column lines."""
+        runs = []
+        run, alignments, previous_starts = [], [], None
+        for line in self.lines(words):
+            starts = self.column_starts(line)
+            aligned = 0.0
+            if len(starts) >= 2 and previous_starts is not None:
+                aligned = self.alignment(starts, previous_starts)
+            if aligned >= 0.5:
+                run.append(line)
+                alignments.append(aligned)
+            else:
+                if len(run) > 1:
+                    runs.append((min(1.0, len(run) / self.min_rows) * float(np.mean(alignments)), run))
+                # A multi-column line may start the next run
+                run, alignments = ([line], []) if len(starts) >= 2 else ([], [])
+            previous_starts = starts if len(starts) >= 2 else None
+        if len(run) > 1:
+            runs.append((min(1.0, len(run) / self.min_rows) * float(np.mean(alignments)), run))
+        return runs
+
+    def candidate_regions(self, page):
+        """Returns (score, [line texts], bbox) for the table candidate runs of a pdfplumber page."""
+        regions = []
+        for score, run in self.score_runs(page.extract_words()):
+            if score >= self.threshold:
+                words = [word for line in run for word in line]
+                bbox = (
+                    min(word["x0"] for word in words),
+                    min(word["top"] for word in words),
+                    max(word["x1"] for word in words),
+                    max(word["bottom"] for word in words),
+                )
+                regions.append((score, [" ".join(word["text"] for word in line) for line in run], bbox))
+        return regions
+
+    def candidate_rows(self, page):
+        """Returns the text of the table candidate rows of a pdfplumber page."""
+        return [row for _, rows, _ in self.candidate_regions(page) for row in rows]
+
+def may_contain_table(text, table_rows, min_overlap=0.6):
+    """Whether text contains one of the table candidate rows of its document."""
+    text_words = set(text.split())
+    for row in table_rows:
+        row_words = row.split()
+        if sum(word in text_words for word in row_words) >= min_overlap * len(row_words):
+            return True
+    return False
+
+LINES_TABLE_SETTINGS = {"vertical_strategy": "lines", "horizontal_strategy": "lines"}
+TEXT_TABLE_SETTINGS = {"vertical_strategy": "text", "horizontal_strategy": "text"}
+
+def table_to_markdown(rows):
+    def cell(value):
+        return " ".join((value or "").split()).replace("|", "\\|")
+
+    header, *body = rows
+    lines = [
+        "| " + " | ".join(cell(value) for value in header) + " |",
+        "|" + "|".join("---" for _ in header) + "|",
+    ]
+    lines += ["| " + " | ".join(cell(value) for value in row) + " |" for row in body]
+    return "\n".join(lines)
+
+class TableEngine:
+    """Builds markdown tables from the page geometry with pdfplumber's table finder.
+
+    Ruled tables are found with the lines strategy. Borderless tables are found
+    with the text strategy, restricted to the candidate regions of the
+    TableDetector. Each table gets a confidence from its cell fill ratio and,
+    for text tables, the detector score and whether the cells reproduce the
+    words of the page lines (words split across cells mean a wrong column guess).
+    """
+
+    def __init__(self, detector):
+        self.detector = detector
+
+    @staticmethod
+    def clean_rows(rows):
+        # Drop empty rows and columns
+        rows = [row for row in rows if any(cell and cell.strip() for cell in row)]
+        if not rows:
+            return rows
+        keep = [i for i in range(len(rows[0])) if any(row[i] and row[i].strip() for row in rows)]
+        return [[row[i] or "" for i in keep] for row in rows]
+
+    @staticmethod
+    def row_text(row):
+        return " ".join(" ".join(row).split())
+
+    @staticmethod
+    def fill_ratio(rows):
+        cells = [cell for row in rows for cell in row]
+        return sum(1 for cell in cells if cell.strip()) / len(cells)
+
+    def extract_tables(self, page):
+        """Returns a dict with the row texts, markdown and confidence of every table of a page."""
+        tables = []
+        ruled_bboxes = []
+        for table in page.find_tables(LINES_TABLE_SETTINGS):
+            rows = self.clean_rows(table.extract())
+            if len(rows) < 2 or len(rows[0]) < 2:
+                continue
+            ruled_bboxes.append(table.bbox)
+            tables.append({
+                "rows": [self.row_text(row) for row in rows],
+                "markdown": table_to_markdown(rows),
+                "confidence": 0.5 + 0.5 * self.fill_ratio(rows),
+            })
+
+        for score, line_texts, bbox in self.detector.candidate_regions(page):
+            x0, top, x1, bottom = bbox
+            if any(x0 >= r[0] and top >= r[1] and x1 <= r[2] and bottom <= r[3] for r in ruled_bboxes):
+                continue
+            # Pad the region a little, within the page
+            region = (max(x0 - 2, page.bbox[0]), max(top - 2, page.bbox[1]),
+                      min(x1 + 2, page.bbox[2]), min(bottom + 2, page.bbox[3]))
+            rows = self.clean_rows(page.crop(region).extract_table(TEXT_TABLE_SETTINGS) or [])
+            if len(rows) < 2 or len(rows[0]) < 2:
+                continue
+            row_texts = [self.row_text(row) for row in rows]
+            intact = sum(1 for row, line in zip(row_texts, line_texts) if row == line) / len(line_texts)
+            if len(rows) != len(line_texts):
+                intact = 0.0
+            tables.append({
+                "rows": line_texts,
+                "markdown": table_to_markdown(rows),
+                "confidence": score * self.fill_ratio(rows) * intact,
+            })
+        return tables
+
+def replace_table_text(text, table):
+    """Replaces the rows of a table in text with its markdown.
+
+    Returns None when the rows are not found one after the other in text.
+    """
+    start = end = None
+    for row in table["rows"]:
+        index = text.find(row, 0 if end is None else end)
+        if index == -1 or (end is not None and text[end:index].strip()):
+            return None
+        if start is None:
+            start = index
+        end = index + len(row)
+    before = text[:start].rstrip()
+    return (before + "\n\n" if before else "") + table["markdown"] + "\n\n" + text[end:].lstrip()
+
+def apply_geometric_tables(texts, tables, min_confidence=TABLE_ENGINE_MIN_CONFIDENCE):
+    """Formats the confident geometric tables of a document into the texts they belong to.
+
+    Returns the new texts, whether each text got a table, and whether each text
+    still contains a table below min_confidence that needs tabel_chain.
+    """
+    # Identical texts, like an explanation shared by several answers, are one
+    # group, so a table goes into every copy of the text it belongs to
+    groups = {}  # text -> indices of the texts
+    for i, text in enumerate(texts):
+        groups.setdefault(text, []).append(i)
+    unique_texts = list(groups)
+    unique_formatted = [False] * len(unique_texts)
+    unique_uncertain = [False] * len(unique_texts)
+    for table in tables:
+        for j, text in enumerate(unique_texts):
+            if table["confidence"] >= min_confidence:
+                replaced = replace_table_text(text, table)
+                if replaced is not None:
+                    unique_texts[j] = replaced
+                    unique_formatted[j] = True
+                    break
+            elif may_contain_table(text, table["rows"]):
+                unique_uncertain[j] = True
+
+    texts = list(texts)
+    formatted = [False] * len(texts)
+    uncertain = [False] * len(texts)
+    for j, indices in enumerate(groups.values()):
+        for i in indices:
+            texts[i] = unique_texts[j]
+            formatted[i] = unique_formatted[j]
+            uncertain[i] = unique_uncertain[j]
+    return texts, formatted, uncertain
+
+def evaluate_table_detector(directory, labels, detector=None):
+    """Reports the precision and recall of the table detector on labelled PDFs.
+
+    Args:
+        directory: The path to the directory containing the PDFs.
+        labels: A dict of filename -> whether the PDF contains a table.
+        detector: The TableDetector to evaluate.
+    """
+    detector = detector or TableDetector(TABLE_PREFILTER_THRESHOLD)
+    tp = fp = fn = tn = 0
+    for filename, has_table in labels.items():
+        with pdfplumber.open(os.path.join(directory, filename)) as pdf:
+            detected = any(detector.candidate_rows(page) for page in pdf.pages)
+        if detected and has_table:
+            tp += 1
+        elif detected:
+            fp += 1
+        elif has_table:
+            fn += 1
+            print(f"Missed table in {filename}")
+        else:
+            tn += 1
+    report = {
+        "precision": tp / (tp + fp) if tp + fp else 1.0,
+        "recall": tp / (tp + fn) if tp + fn else 1.0,
+        # Share of documents whose table LLM calls are skipped
+        "skipped": (fn + tn) / len(labels) if labels else 0.0,
+    }
+    print(f"Table detector (threshold {detector.threshold}): {report}")
+    return report
 
 # Function to append JSON to file
 def append_json_to_file(json_object, filename):
@@ -290,60 +1161,558 @@ def append_json_to_file(json_object, filename):
         with open(filename, 'w') as file:
             json.dump([json_object], file, indent=4)
 
-def list_tables_and_rephrase(text, tabel_chain, rephrase_chain, retries=3):
-    """Rephrases content and detects tables, with retry mechanism for errors."""
-    attempt = 0  # Track the number of retries
-    while attempt < retries:
+def json_default(value):
+    """Serializes the ObjectId and datetime values of a record."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_json_line(json_object):
+    if orjson is not None:
+        return orjson.dumps(json_object, default=json_default, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(json_object, default=json_default, ensure_ascii=False) + "\n").encode("utf-8")
+
+JSONL_SUFFIXES = {"": "", "gzip": ".gz", "zstd": ".zst"}
+
+def open_jsonl(path, mode):
+    """Opens a JSON Lines file, (de)compressing it based on its suffix."""
+    encoding = "utf-8" if "t" in mode else None
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding=encoding)
+    if path.endswith(".zst"):
+        import zstandard
+        return zstandard.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+class JsonlWriter:
+    """Appends records to JSON Lines files that stay open for the whole run.
+
+    Each record is one line, so an append never rewrites the file.
+    """
+
+    def __init__(self, compression=""):
+        if compression not in JSONL_SUFFIXES:
+            raise ValueError(f"Unsupported JSONL compression: {compression}")
+        self.suffix = JSONL_SUFFIXES[compression]
+        self.files = {}  # jsonl_path -> open file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, json_object, jsonl_path):
+        if jsonl_path not in self.files:
+            self.files[jsonl_path] = open_jsonl(jsonl_path + self.suffix, "ab")
+        self.files[jsonl_path].write(dumps_json_line(json_object))
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+def jsonl_to_json(jsonl_path, json_path):
+    """Converts a (possibly compressed) JSON Lines file to the legacy single-array JSON file."""
+    with open_jsonl(jsonl_path, "rt") as file:
+        file_data = [json.loads(line) for line in file if line.strip()]
+    with open(json_path, 'w') as file:
+        json.dump(file_data, file, indent=4)
+
+def parse_table_response(content):
+    """Returns the (content, table_detected) of a table chain response.
+
+    Raises ValueError or KeyError when the response is not the expected JSON.
+    """
+    print(content)
+    json_content = content.strip('```json').strip('```')
+    try:
+        parsed_data = json.loads(json_content)
+        print("JSON file parsed successfully.")
+        print(parsed_data['table_detected'])
+    except json.JSONDecodeError:
+        raise ValueError("Invalid JSON format detected.")
+    return parsed_data['content'], parsed_data['table_detected']
+
+def rephrase_retry_delay(error, attempt, retries):
+    """Returns the seconds to wait before retrying a failed table detection and rephrase, or None to give up."""
+    if isinstance(error, (json.JSONDecodeError, KeyError, ValueError)):
+        print(f"Error encountered: {error}. Retrying... {attempt + 1}/{retries}")
+        return 2  # Wait for a short duration before retrying
+    if is_rate_limit_error(error):
+        # Rate limits are temporary; wait for the server instead of giving up
+        delay = retry_after_seconds(error) or backoff_delay(attempt, LLM_BACKOFF_SECONDS)
+        print(f"Rate limited: {error}. Retrying in {delay:.1f}s... {attempt + 1}/{retries}")
+        return delay
+    print(f"An unexpected error occurred: {error}.")
+    return None
+
+def rephrase_failed(error=None):
+    """Returns the result of a text that could not be rephrased."""
+    if error is None:
+        print("Max retries reached or an unrecoverable error occurred.")
+    else:
+        print(f"An unexpected error occurred: {error}.")
+    return None, None, False
+
+def list_tables_and_rephrase(text, tabel_chain, rephrase_chain, retries=3, detect_tables=True):
+    """Rephrases content and detects tables, with retry mechanism for errors.
+
+    With detect_tables=False the table chain is skipped and the text is rephrased as is.
+    """
+    if not detect_tables:
+        return rephrase_without_tables(text, rephrase_chain)
+    for attempt in range(retries):
         try:
-            # Step 1: Invoke the table chain with the input text
+            # Detect the tables, then rephrase the content the table chain returned
             response = tabel_chain.invoke({
                 "text": text,
             })
+            content, tables_present = parse_table_response(response.content)
+            rephrased_response = rephrase_chain.invoke({
+                "text": content
+            })
+            return rephrased_response.content, tables_present, True
+        except Exception as e:
+            delay = rephrase_retry_delay(e, attempt, retries)
+            if delay is None:
+                break
+            time.sleep(delay)
+    return rephrase_failed()
+
+def rephrase_without_tables(text, rephrase_chain):
+    """Rephrases text the table detector ruled out, without the table chain."""
+    try:
+        rephrased_response = rephrase_chain.invoke({
+            "text": text
+        })
+        return rephrased_response.content, False, True
+    except Exception as e:
+        return rephrase_failed(e)
+
+async def arephrase_without_tables(text, rephrase_chain, semaphore):
+    """Async version of rephrase_without_tables."""
+    try:
+        async with semaphore:
+            rephrased_response = await rephrase_chain.ainvoke({
+                "text": text
+            })
+        return rephrased_response.content, False, True
+    except Exception as e:
+        return rephrase_failed(e)
+
+async def alist_tables_and_rephrase(text, tabel_chain, rephrase_chain, semaphore, retries=3, detect_tables=True):
+    """Async version of list_tables_and_rephrase. Every chain call is bounded by the semaphore."""
+    if not detect_tables:
+        return await arephrase_without_tables(text, rephrase_chain, semaphore)
+    for attempt in range(retries):
+        try:
+            async with semaphore:
+                response = await tabel_chain.ainvoke({
+                    "text": text,
+                })
+            content, tables_present = parse_table_response(response.content)
+            async with semaphore:
+                rephrased_response = await rephrase_chain.ainvoke({
+                    "text": content
+                })
+            return rephrased_response.content, tables_present, True
+        except Exception as e:
+            delay = rephrase_retry_delay(e, attempt, retries)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+    return rephrase_failed()
+
+# Speculative rephrases used and discarded, and the seconds they saved
+speculation_stats = collections.Counter()
+speculation_stats_lock = threading.Lock()
+speculation_executor = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) if SPECULATIVE_REPHRASE else None
+
+def count_speculation(outcome, seconds_saved=0.0):
+    with speculation_stats_lock:
+        speculation_stats[outcome] += 1
+        speculation_stats["seconds_saved"] += seconds_saved
+
+def timed_invoke(chain, inputs):
+    return chain.invoke(inputs), time.perf_counter()
+
+async def timed_ainvoke(chain, inputs):
+    return await chain.ainvoke(inputs), time.perf_counter()
+
+class SpeculativeChain:
+    """Stands in for rephrase_chain while a rephrase of the raw text runs ahead.
+
+    The speculative response is returned when the chain is invoked with the
+    raw text, i.e. when tabel_chain returned the text unchanged; any other
+    text is rephrased by the wrapped chain and the speculation is discarded.
+    """
 
-            print(response.content)
+    def __init__(self, chain, text, speculation, started):
+        self.chain = chain
+        self.text = text
+        self.speculation = speculation
+        self.started = started
+
+    def is_hit(self, inputs):
+        if inputs["text"].strip() == self.text.strip():
+            return True
+        count_speculation("misses")
+        return False
+
+    def use(self, response, finished, requested):
+        # Without speculation the rephrase would have started when it was requested
+        duration = finished - self.started
+        count_speculation("hits", requested + duration - max(requested, finished))
+        return response
+
+    def discard(self, error):
+        print(f"Speculative rephrase failed: {error}.")
+        count_speculation("failed")
+
+    def invoke(self, inputs):
+        if self.is_hit(inputs):
+            requested = time.perf_counter()
+            try:
+                response, finished = self.speculation.result()
+                return self.use(response, finished, requested)
+            except Exception as e:
+                self.discard(e)
+        return self.chain.invoke(inputs)
+
+    async def ainvoke(self, inputs):
+        if self.is_hit(inputs):
+            requested = time.perf_counter()
+            try:
+                response, finished = await self.speculation
+                return self.use(response, finished, requested)
+            except Exception as e:
+                self.discard(e)
+        return await self.chain.ainvoke(inputs)
+
+def speculative_rephrase(text, tabel_chain, rephrase_chain, retries=3, detect_tables=True):
+    """list_tables_and_rephrase with the rephrase of the raw text started next to tabel_chain."""
+    if not detect_tables:
+        return rephrase_without_tables(text, rephrase_chain)
+    started = time.perf_counter()
+    speculation = speculation_executor.submit(timed_invoke, rephrase_chain, {"text": text})
+    speculative_chain = SpeculativeChain(rephrase_chain, text, speculation, started)
+    return list_tables_and_rephrase(text, tabel_chain, speculative_chain, retries)
+
+async def aspeculative_rephrase(text, tabel_chain, rephrase_chain, semaphore, retries=3, detect_tables=True):
+    """Async version of speculative_rephrase.
+
+    The speculative call does not take a semaphore slot: the call waiting for
+    it holds one, and the two would deadlock at low concurrency.
+    """
+    if not detect_tables:
+        return await arephrase_without_tables(text, rephrase_chain, semaphore)
+    started = time.perf_counter()
+    speculation = asyncio.ensure_future(timed_ainvoke(rephrase_chain, {"text": text}))
+    speculative_chain = SpeculativeChain(rephrase_chain, text, speculation, started)
+    result = await alist_tables_and_rephrase(text, tabel_chain, speculative_chain, semaphore, retries)
+    if not speculation.done():
+        speculation.cancel()
+    return result
+
+def speculation_summary():
+    hits, misses = speculation_stats["hits"], speculation_stats["misses"]
+    return {
+        "hits": hits,
+        "misses": misses,
+        "failed": speculation_stats["failed"],
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "seconds_saved": round(speculation_stats["seconds_saved"], 2),
+    }
 
-            # Step 2: Parse the JSON response
-            json_content = response.content.strip('```json').strip('```')
+# Texts rephrased by the fused chain, and texts that fell back to the two calls
+fused_stats = collections.Counter()
+fused_stats_lock = threading.Lock()
 
-            try:
-                parsed_data = json.loads(json_content)
-                print("JSON file parsed successfully.")
-                print(parsed_data['table_detected'])
-            except json.JSONDecodeError:
-                raise ValueError("Invalid JSON format detected.")
-            
-            # Extract Tables and content
-            tables_present = parsed_data['table_detected']
-
-            # Step 3: Rephrase the content
-            rephrased_response = rephrase_chain.invoke({
-                "text": parsed_data['content']
+def count_fused(outcome):
+    with fused_stats_lock:
+        fused_stats[outcome] += 1
+
+def fused_result(response):
+    """Returns the result of a fused chain response, or None to fall back to the two calls.
+
+    response is the exception raised by the call when it failed.
+    """
+    if isinstance(response, Exception):
+        print(f"Fused call failed: {response}. Falling back to table detection and rephrasing.")
+    else:
+        result = parse_fused_response(response.content)
+        if result is not None:
+            count_fused("fused")
+            return result.rephrased_content, result.table_detected, True
+        print("Invalid fused response. Falling back to table detection and rephrasing.")
+    count_fused("fallback")
+    return None
+
+def fused_rephrase(text, fused_chain, tabel_chain, rephrase_chain, retries=3, detect_tables=True):
+    """Detects tables and rephrases content with a single call of the fused chain.
+
+    Falls back to list_tables_and_rephrase when the call fails or its
+    response does not validate.
+    """
+    if not detect_tables:
+        return rephrase_without_tables(text, rephrase_chain)
+    try:
+        response = fused_chain.invoke({
+            "text": text
+        })
+    except Exception as e:
+        response = e
+    return fused_result(response) or list_tables_and_rephrase(text, tabel_chain, rephrase_chain, retries)
+
+async def afused_rephrase(text, fused_chain, tabel_chain, rephrase_chain, semaphore, retries=3, detect_tables=True):
+    """Async version of fused_rephrase."""
+    if not detect_tables:
+        return await arephrase_without_tables(text, rephrase_chain, semaphore)
+    try:
+        async with semaphore:
+            response = await fused_chain.ainvoke({
+                "text": text
             })
+    except Exception as e:
+        response = e
+    return fused_result(response) or await alist_tables_and_rephrase(text, tabel_chain, rephrase_chain, semaphore, retries)
 
-            # Step 4: Return the rephrased content and tables
-            return rephrased_response.content, tables_present, True
+async def arephrase_texts(texts, detect_tables, concurrency=LLM_CONCURRENCY, semaphore=None):
+    """Sends all texts of a document to the LLM concurrently.
 
-        except (json.JSONDecodeError, KeyError, ValueError) as e:
-            print(f"Error encountered: {e}. Retrying... {attempt + 1}/{retries}")
-            attempt += 1
-            time.sleep(2)  # Wait for a short duration before retrying
+    The calls share semaphore when it is given. Returns the
+    (content, table_detected, complete) results in the order of texts.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+    if FUSED_LLM:
+        return await asyncio.gather(*[
+            afused_rephrase(text, fused_chain, tabel_chain, rephrase_chain, semaphore, detect_tables=detect)
+            for text, detect in zip(texts, detect_tables)
+        ])
+    if SPECULATIVE_REPHRASE:
+        return await asyncio.gather(*[
+            aspeculative_rephrase(text, tabel_chain, rephrase_chain, semaphore, detect_tables=detect)
+            for text, detect in zip(texts, detect_tables)
+        ])
+    return await asyncio.gather(*[
+        alist_tables_and_rephrase(text, tabel_chain, rephrase_chain, semaphore, detect_tables=detect)
+        for text, detect in zip(texts, detect_tables)
+    ])
+
+# The async LLM calls of every thread run on one event loop: the async client of the
+# model keeps its connections bound to the loop that opened them
+llm_loop = None
+llm_loop_lock = threading.Lock()
+
+def run_async(coroutine):
+    """Runs a coroutine on the shared LLM event loop and returns its result.
+
+    The loop is started in a daemon thread on first use. The LLM workers of
+    the pipeline call this from their own threads, so it must not be called
+    from the loop itself.
+    """
+    global llm_loop
+    with llm_loop_lock:
+        if llm_loop is None:
+            llm_loop = asyncio.new_event_loop()
+            threading.Thread(target=llm_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, llm_loop).result()
 
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}.")
-            break
+# Explanation batches sent, explanations rephrased in a batch, and explanations sent one by one
+batch_stats = collections.Counter()
+batch_stats_lock = threading.Lock()
 
-    print("Max retries reached or an unrecoverable error occurred.")
-    return None, None, False
+def count_batch(outcome, count=1):
+    with batch_stats_lock:
+        batch_stats[outcome] += count
+
+def split_batches(items, token_budget):
+    """Groups (choice, text) items, in order, into batches of at most token_budget estimated tokens.
 
-def append_content_to_docx(data, image_paths, docx_path):
+    An item larger than the budget gets a batch of its own.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for choice, text in items:
+        tokens = estimate_tokens(text)
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((choice, text))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def batch_inputs(batch):
+    return {"text": json.dumps({str(choice): text for choice, text in batch}, ensure_ascii=False)}
+
+def collect_batch(batch, response, results):
+    """Adds the items of a batch response that validate to results.
+
+    response is the exception raised by the call when it failed.
+    """
+    if isinstance(response, Exception):
+        print(f"Batch call failed: {response}.")
+        batch_results = {}
+    else:
+        batch_results = parse_batch_response(response.content)
+    count_batch("batches")
+    for choice, _ in batch:
+        if str(choice) in batch_results:
+            results[choice] = batch_results[str(choice)]
+    missing = len(batch) - sum(choice in results for choice, _ in batch)
+    if missing:
+        print(f"{missing} explanations missing from the batch response. Sending them one by one.")
+
+def rephrase_batches(items, batch_chain, token_budget=BATCH_TOKEN_BUDGET):
+    """Detects tables and rephrases (choice, text) items with one batch_chain call per batch.
+
+    Returns {choice: (content, table_detected)} for the items whose response
+    validated; the caller rephrases the others one by one.
+    """
+    results = {}
+    for batch in split_batches(items, token_budget):
+        try:
+            response = batch_chain.invoke(batch_inputs(batch))
+        except Exception as e:
+            response = e
+        collect_batch(batch, response, results)
+    return results
+
+async def arephrase_batches(items, batch_chain, semaphore, token_budget=BATCH_TOKEN_BUDGET):
+    """Async version of rephrase_batches. The batches are sent concurrently, bounded by the semaphore."""
+    async def call(batch):
+        try:
+            async with semaphore:
+                return await batch_chain.ainvoke(batch_inputs(batch))
+        except Exception as e:
+            return e
+
+    batches = split_batches(items, token_budget)
+    responses = await asyncio.gather(*[call(batch) for batch in batches])
+    results = {}
+    for batch, response in zip(batches, responses):
+        collect_batch(batch, response, results)
+    return results
+
+# Texts that shared the LLM result of an identical text of their document
+duplicate_texts = collections.Counter()
+duplicate_texts_lock = threading.Lock()
+
+def rephrase_texts(texts, detect_tables=None, choices=None):
+    """Detects tables and rephrases every text of a document.
+
+    detect_tables tells, per text, whether the table chain is needed (all by default).
+    With BATCH_EXPLANATIONS, texts[1:] are explanations sent in batches keyed
+    by choices (1, 2, ... by default). Texts that are identical up to
+    whitespace, such as the explanation of "(Choices 2 & 3)", are sent once
+    and get the same result.
+    Returns a list of (content, table_detected, complete) in the order of texts.
+    """
+    if detect_tables is None:
+        detect_tables = [True] * len(texts)
+    if choices is None:
+        choices = list(range(1, len(texts)))
+    groups = {}
+    for i, text in enumerate(texts):
+        groups.setdefault(" ".join(text.split()), []).append(i)
+    if len(groups) < len(texts):
+        with duplicate_texts_lock:
+            duplicate_texts["texts"] += len(texts) - len(groups)
+    # The first text of every group is sent; texts[0], the question, stays first
+    indexes = list(groups.values())
+    unique_results = rephrase_unique_texts(
+        [texts[group[0]] for group in indexes],
+        [any(detect_tables[i] for i in group) for group in indexes],
+        [choices[group[0] - 1] for group in indexes[1:]],
+    )
+    results = [None] * len(texts)
+    for group, result in zip(indexes, unique_results):
+        for i in group:
+            results[i] = result
+    return results
+
+def unbatched_indexes(choices, batched):
+    """Returns the indexes, in texts, of the explanations missing from the batch responses."""
+    return [i + 1 for i, choice in enumerate(choices) if choice not in batched]
+
+def merge_batched(texts, choices, batched, rephrased, rephrased_results):
+    """Puts the batch results and the results of the texts rephrased one by one in the order of texts."""
+    count_batch("batched", len(batched))
+    count_batch("one_by_one", len(choices) - len(batched))
+    results = [None] * len(texts)
+    for i, result in zip(rephrased, rephrased_results):
+        results[i] = result
+    for i, choice in enumerate(choices):
+        if choice in batched:
+            results[i + 1] = (*batched[choice], True)
+    return results
+
+def rephrase_unique_texts(texts, detect_tables, choices):
+    """Detects tables and rephrases the distinct texts of a document, in batches or one by one."""
+    if BATCH_EXPLANATIONS and len(texts) > 2:
+        if ASYNC_LLM:
+            return run_async(arephrase_unique_texts(texts, detect_tables, choices))
+        batched = rephrase_batches(list(zip(choices, texts[1:])), batch_chain)
+        # The question and the explanations missing from the batch responses
+        remaining = [0] + unbatched_indexes(choices, batched)
+        remaining_results = rephrase_each([texts[i] for i in remaining], [detect_tables[i] for i in remaining])
+        return merge_batched(texts, choices, batched, remaining, remaining_results)
+    return rephrase_each(texts, detect_tables)
+
+async def arephrase_unique_texts(texts, detect_tables, choices, concurrency=LLM_CONCURRENCY):
+    """Async version of the batched path of rephrase_unique_texts.
+
+    The question is sent together with the batches; the explanations missing
+    from the batch responses follow once the batches are answered.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    question_results, batched = await asyncio.gather(
+        arephrase_texts(texts[:1], detect_tables[:1], semaphore=semaphore),
+        arephrase_batches(list(zip(choices, texts[1:])), batch_chain, semaphore),
+    )
+    missing = unbatched_indexes(choices, batched)
+    missing_results = await arephrase_texts(
+        [texts[i] for i in missing], [detect_tables[i] for i in missing], semaphore=semaphore)
+    return merge_batched(texts, choices, batched, [0] + missing, question_results + missing_results)
+
+def rephrase_each(texts, detect_tables):
+    """Detects tables and rephrases texts one request per text."""
+    if ASYNC_LLM:
+        return run_async(arephrase_texts(texts, detect_tables))
+    if FUSED_LLM:
+        return [
+            fused_rephrase(text, fused_chain, tabel_chain, rephrase_chain, detect_tables=detect)
+            for text, detect in zip(texts, detect_tables)
+        ]
+    if SPECULATIVE_REPHRASE:
+        return [
+            speculative_rephrase(text, tabel_chain, rephrase_chain, detect_tables=detect)
+            for text, detect in zip(texts, detect_tables)
+        ]
+    return [
+        list_tables_and_rephrase(text, tabel_chain, rephrase_chain, detect_tables=detect)
+        for text, detect in zip(texts, detect_tables)
+    ]
+
+def open_docx(docx_path):
     # Check if the file exists
     if os.path.exists(docx_path):
         # Open the existing document
-        doc = Document(docx_path)
-    else:
-        # Create a new document
-        doc = Document()
+        return Document(docx_path)
+    # Create a new document
+    return Document()
 
+def add_content_to_doc(doc, data, images):
     # Add the filename as a heading
     doc.add_heading(data.get('filename', ''), level=1)
     
@@ -371,17 +1740,69 @@ def append_content_to_docx(data, image_paths, docx_path):
                 doc.add_paragraph(f"Explanation: {explanation}", style='Quote')
     
     # Add the images
-    if image_paths:
+    if images:
         doc.add_heading('Images:', level=2)
-        for img_path in image_paths:
-            doc.add_picture(img_path)
+        for image_data in images:
+            doc.add_picture(io.BytesIO(image_data))
+
+def append_content_to_docx(data, images, docx_path):
+    doc = open_docx(docx_path)
+    add_content_to_doc(doc, data, images)
 
     # Save the document
     doc.save(docx_path)
 
+class DocxWriter:
+    """Keeps the output documents open for the whole run.
+
+    The documents are saved once one of them has checkpoint_every unsaved
+    questions and on close, instead of being reloaded and saved for each
+    question. on_checkpoint, if given, is called after every save, when all
+    questions appended so far are on disk.
+    """
+
+    def __init__(self, checkpoint_every=50, on_checkpoint=None):
+        self.checkpoint_every = checkpoint_every
+        self.on_checkpoint = on_checkpoint
+        self.docs = {}      # docx_path -> Document
+        self.pending = {}   # docx_path -> questions appended since the last save
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, data, images, docx_path):
+        if docx_path not in self.docs:
+            self.docs[docx_path] = open_docx(docx_path)
+            self.pending[docx_path] = 0
+        add_content_to_doc(self.docs[docx_path], data, images)
+        self.pending[docx_path] += 1
+        if self.pending[docx_path] >= self.checkpoint_every:
+            self.checkpoint()
 
-def upload_image_to_firebase(image_path, filename, question_id):
+    def save(self, docx_path):
+        self.docs[docx_path].save(docx_path)
+        self.pending[docx_path] = 0
+
+    def checkpoint(self):
+        for docx_path, pending in self.pending.items():
+            if pending:
+                self.save(docx_path)
+        if self.on_checkpoint:
+            self.on_checkpoint()
+
+    def close(self):
+        self.checkpoint()
+
+
+IMAGE_CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+def upload_image_to_firebase(image_data, filename, question_id, bucket=None):
     """Uploads an image to Firebase Storage and returns the image URL."""
+    if bucket is None:
+        bucket = get_bucket()
     
     # Define the folder path in Firebase Storage
     folder_path = f"question-assets/{BANK_NAME}/{question_id}/"
@@ -392,8 +1813,9 @@ def upload_image_to_firebase(image_path, filename, question_id):
     # Create the blob (the file object) with the full path
     blob = bucket.blob(firebase_storage_path)
     
-    # Upload the image from the local image path
-    blob.upload_from_filename(image_path)
+    # Upload the encoded image
+    extension = filename.rsplit(".", 1)[-1]
+    blob.upload_from_string(image_data, content_type=IMAGE_CONTENT_TYPES.get(extension, "image/png"))
     
     # Get the public URL and Firebase path
     firebase_url = blob.public_url  # The URL to access the image publicly
@@ -404,128 +1826,1052 @@ def upload_image_to_firebase(image_path, filename, question_id):
         "path": firebase_path  # The full path inside the Firebase bucket
     }
 
+class ImageIndex:
+    """SQLite index of uploaded images, keyed by the bucket name and the sha256 of their bytes."""
+
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                url TEXT NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, url, size FROM images WHERE hash = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes_saved += row[2]
+            return {"path": row[0], "url": row[1], "size": row[2]}
+
+    def put(self, key, image):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images (hash, path, url, size) VALUES (?, ?, ?, ?)",
+                (key, image["path"], image["url"], image["size"]),
+            )
+            self.conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved}
+
+class Manifest:
+    """SQLite manifest of the PDFs of a run, keyed by the sha256 of their content.
+
+    Every PDF records the last stage it completed (parsed, rephrased,
+    uploaded, stored), whether its last attempt failed, and the results of
+    the completed stages, so a rerun can resume where the file stopped.
+    """
+
+    STAGES = ("parsed", "rephrased", "uploaded", "stored")
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                payload TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, pdf_hash):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, stage, failed, error, payload FROM files WHERE hash = ?", (pdf_hash,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"path": row[0], "stage": row[1], "failed": bool(row[2]), "error": row[3],
+                "payload": json.loads(row[4])}
+
+    def is_stored(self, pdf_hash):
+        entry = self.get(pdf_hash)
+        return entry is not None and entry["stage"] == "stored"
+
+    def update(self, pdf_hash, path, stage=None, error=None, **payload):
+        """Records a completed stage and its results, or the error of a failed attempt.
+
+        The stage never moves backwards and the payload is merged into the
+        stored one. A call without error clears the failed flag.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT stage, payload FROM files WHERE hash = ?", (pdf_hash,)).fetchone()
+            current_stage, current_payload = (row[0], json.loads(row[1])) if row else ("parsed", {})
+            if stage is None or self.STAGES.index(stage) < self.STAGES.index(current_stage):
+                stage = current_stage
+            current_payload.update(payload)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (hash, path, stage, failed, error, payload, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (pdf_hash, path, stage, int(error is not None), error, json.dumps(current_payload, default=json_default), time.time()),
+            )
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT CASE WHEN failed THEN 'failed' ELSE stage END, COUNT(*) FROM files GROUP BY 1"
+            ).fetchall()
+        return dict(rows)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_image(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+def upload_image(image_data, filename, question_id, image_index, image_hash=None,
+                 bucket=None, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF_SECONDS):
+    """Uploads an image unless the same bytes were uploaded before.
+
+    Failed uploads are retried with exponential backoff and jitter.
+    Returns the url, path and size of the (possibly existing) blob.
+    """
+    if bucket is None:
+        bucket = get_bucket()
+    image_hash = image_hash or hash_image(image_data)
+    # A blob is only reused within the bucket it was uploaded to
+    index_key = f"{bucket.name}/{image_hash}"
+    image = image_index.get(index_key)
+    if image is None:
+        # retries counts the attempts; there is always at least one
+        attempts = max(1, retries)
+        for attempt in range(attempts):
+            try:
+                # Upload the image and get the URL and path in the Firebase bucket
+                image = upload_image_to_firebase(image_data, filename, question_id, bucket)
+                break
+            except Exception as e:
+                if attempt + 1 == attempts:
+                    raise
+                delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+                print(f"Upload of {filename} failed: {e}. Retrying in {delay:.1f}s... {attempt + 1}/{attempts}")
+                time.sleep(delay)
+        # Get the image size in bytes
+        image["size"] = len(image_data)
+        image_index.put(index_key, image)
+    return image
+
+class ImageUploader:
+    """Uploads images from a thread pool so the caller does not wait on storage.
+
+    submit returns a future of the upload_image result. Identical images
+    submitted while the first one is still uploading share its future.
+    Without a bucket, the images go to the Firebase bucket of get_bucket.
+    """
+
+    def __init__(self, image_index, workers=8, retries=3, backoff=1.0, bucket=None):
+        self.image_index = image_index
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = bucket if bucket is not None else get_bucket()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = {}  # image hash -> future
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, image_data, filename, question_id):
+        image_hash = hash_image(image_data)
+        with self.lock:
+            if image_hash in self.in_flight:
+                return self.in_flight[image_hash]
+            future = self.executor.submit(
+                upload_image, image_data, filename, question_id, self.image_index, image_hash,
+                self.bucket, self.retries, self.backoff,
+            )
+            self.in_flight[image_hash] = future
+        future.add_done_callback(lambda _: self.done(image_hash))
+        return future
+
+    def done(self, image_hash):
+        with self.lock:
+            self.in_flight.pop(image_hash, None)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def upsert_operation(record):
+    fields = {key: value for key, value in record.items() if key not in ("_id", "createdAt")}
+    return UpdateOne(
+        {"_id": record["_id"]},
+        {"$set": fields, "$setOnInsert": {"createdAt": record["createdAt"]}},
+        upsert=True,
+    )
+
+class MongoWriter:
+    """Buffers records and writes them with unordered insert_many.
+
+    The buffer is flushed every batch_size records, every flush_interval
+    seconds and on close. Filenames of records that fail to insert are
+    appended to the failed list. on_stored, if given, is called from the
+    flushing thread with the key passed to add and None, or the error of a
+    failed insert.
+
+    With upsert the records are written with an unordered bulk_write of
+    upserts on their _id: an existing record is updated in place and keeps
+    its createdAt.
+    """
+
+    def __init__(self, collection, failed, batch_size=100, flush_interval=5.0, on_stored=None, upsert=False):
+        self.collection = collection
+        self.failed = failed
+        self.on_stored = on_stored
+        self.upsert = upsert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.inserted = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, record, key=None):
+        with self.lock:
+            self.buffer.append((record, key))
+            if len(self.buffer) >= self.batch_size:
+                self.flush_locked()
+
+    def skip(self, key):
+        """Reports a record that a previous run already wrote as stored, without writing it again."""
+        if self.on_stored:
+            self.on_stored(key, None)
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.buffer:
+            return
+        buffer, self.buffer = self.buffer, []
+        records = [record for record, _ in buffer]
+        errors = {}
+        try:
+            if self.upsert:
+                result = self.collection.bulk_write([upsert_operation(record) for record in records], ordered=False)
+                self.inserted += result.upserted_count + result.matched_count
+            else:
+                result = self.collection.insert_many(records, ordered=False)
+                self.inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = {error["index"]: error.get("errmsg") for error in e.details.get("writeErrors", [])}
+            if self.upsert:
+                self.inserted += e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+            else:
+                self.inserted += e.details.get("nInserted", len(records) - len(errors))
+            for index in sorted(errors):
+                print(f"Failed to insert {records[index].get('filename')}: {records[index]['_id']}")
+                self.failed.append(records[index].get("filename"))
+        except PyMongoError as e:
+            print(f"Failed to insert {len(records)} records: {e}")
+            self.failed.extend(record.get("filename") for record in records)
+            errors = {index: str(e) for index in range(len(records))}
+        if self.on_stored:
+            for index, (_, key) in enumerate(buffer):
+                self.on_stored(key, errors.get(index))
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        self.timer.join()
+        self.flush()
+
+table_detector = TableDetector(TABLE_PREFILTER_THRESHOLD)
+table_engine = TableEngine(table_detector)
+
 incomplete = []
+# Normalization rule hits summed over all documents
+normalization_hits = {}
+# Bytes saved by the image optimizer over all documents
+image_bytes_saved = 0
+# Decorative images skipped over all documents, per reason
+image_filter_hits = {}
+
+def render_image(page, img, resolution=72):
+    """Renders the region of an image and returns it as PNG bytes."""
+    x0, y0, x1, y1 = img["x0"], img["top"], img["x1"], img["bottom"]
+    cropped_image = page.within_bbox((x0, y0, x1, y1)).to_image(resolution=resolution)
+    buffer = io.BytesIO()
+    cropped_image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def render_page_images(page, imgs, resolution=72):
+    """Renders the page once and crops every image from that bitmap.
+
+    Returns the PNG bytes of each image, in the order of imgs. The page
+    bitmap is released before returning.
+    """
+    page_image = page.to_image(resolution=resolution)
+    pixels = np.asarray(page_image.original)
+    scale = resolution / 72
+    page_x0, page_top, page_x1, page_bottom = page.bbox
+    images = []
+    for img in imgs:
+        # Clip to the page, as within_bbox does, then convert points to pixels
+        x0, top = max(img["x0"], page_x0), max(img["top"], page_top)
+        x1, bottom = min(img["x1"], page_x1), min(img["bottom"], page_bottom)
+        # Round the far edges themselves; rounding the size instead can shift them by a pixel
+        left, upper = round((x0 - page_x0) * scale), round((top - page_top) * scale)
+        right = max(round((x1 - page_x0) * scale), left + 1)
+        lower = max(round((bottom - page_top) * scale), upper + 1)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels[upper:lower, left:right]).save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    del pixels
+    page_image.original.close()
+    return images
+
+# Filters pdfminer fully decodes; a DCTDecode stream is returned as the JPEG itself
+DECODABLE_FILTERS = (
+    LITERALS_ASCII85_DECODE + LITERALS_ASCIIHEX_DECODE + LITERALS_FLATE_DECODE
+    + LITERALS_LZW_DECODE + LITERALS_RUNLENGTH_DECODE
+)
 
-def extract_pdfs(directory):
-    """Converts PDFs in a directory to a single JSON file.
+def image_mode(colorspace):
+    """Returns the PIL mode of an image color space, or None when it is not supported."""
+    colorspace = resolve1(colorspace)
+    if isinstance(colorspace, list):
+        if len(colorspace) == 1:
+            return image_mode(colorspace[0])
+        if len(colorspace) == 2 and getattr(colorspace[0], "name", None) == "ICCBased":
+            return {1: "L", 3: "RGB"}.get(resolve1(colorspace[1]).get("N"))
+        return None
+    return {"DeviceGray": "L", "DeviceRGB": "RGB"}.get(getattr(colorspace, "name", None))
+
+def extract_embedded_image(img):
+    """Extracts an image XObject from the PDF without rendering the page.
+
+    JPEG streams are passed through as they are; other streams are decoded
+    and encoded as PNG. Returns (bytes, extension), or None for images that
+    need the render path (masks, transparency, CMYK, JPEG 2000, CCITT, JBIG2...).
+    """
+    stream = img["stream"]
+    filters = [name for name, _ in stream.get_filters()]
+    if img.get("imagemask") or stream.get("SMask") or stream.get("Mask") or stream.get("Decode"):
+        return None
+    mode = image_mode(stream.get("ColorSpace"))
+    if mode is None:
+        return None
+
+    if filters and filters[-1] in LITERALS_DCT_DECODE:
+        if all(name in DECODABLE_FILTERS for name in filters[:-1]):
+            return stream.get_data(), "jpg"
+        return None
+
+    if all(name in DECODABLE_FILTERS for name in filters) and img.get("bits") == 8:
+        width, height = img["srcsize"]
+        data = stream.get_data()
+        if len(data) != width * height * len(mode):
+            return None
+        buffer = io.BytesIO()
+        Image.frombytes(mode, (width, height), data).save(buffer, format="PNG")
+        return buffer.getvalue(), "png"
+    return None
+
+def perceptual_hash(image_data):
+    """Returns the 64-bit difference hash of an encoded image as a hex string."""
+    image = Image.open(io.BytesIO(image_data)).convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).flatten())
+    return bits.tobytes().hex()
+
+class ImageFilter:
+    """Tells content images from decorative ones (icons, checkmarks, logos).
+
+    is_content_geometry runs on the page.images entry, before the image is
+    cropped; is_blocked compares the perceptual hash of the extracted image
+    with the blocklist. Skipped images are counted per reason.
+    """
+
+    def __init__(self, min_area=400, max_aspect_ratio=10, blocked_hashes=(), max_distance=4):
+        self.min_area = min_area
+        self.max_aspect_ratio = max_aspect_ratio
+        self.blocked_hashes = [int(image_hash, 16) for image_hash in blocked_hashes]
+        self.max_distance = max_distance
+
+    def is_content_geometry(self, img, hits):
+        width, height = img["x1"] - img["x0"], img["bottom"] - img["top"]
+        if width * height < self.min_area:
+            hits["small"] = hits.get("small", 0) + 1
+            return False
+        if max(width, height) > self.max_aspect_ratio * max(min(width, height), 1e-6):
+            hits["aspect_ratio"] = hits.get("aspect_ratio", 0) + 1
+            return False
+        return True
+
+    def is_blocked(self, image_data, hits):
+        if not self.blocked_hashes:
+            return False
+        image_hash = int(perceptual_hash(image_data), 16)
+        if any(bin(image_hash ^ blocked).count("1") <= self.max_distance for blocked in self.blocked_hashes):
+            hits["blocked"] = hits.get("blocked", 0) + 1
+            return True
+        return False
+
+def load_decorative_hashes(path):
+    if path and os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return []
+
+def learn_decorative_hashes(directory, output_path=DECORATIVE_HASHES_PATH, top_n=50, min_documents=3):
+    """Finds the images repeated across the most PDFs of a corpus and saves their perceptual hashes.
 
     Args:
         directory: The path to the directory containing PDFs.
-        output_file: The path to the output JSON file.
+        output_path: The JSON file the hashes are written to (the blocklist of ImageFilter).
+        top_n: The maximum number of hashes to keep.
+        min_documents: The minimum number of PDFs an image must appear in.
     """
-        
+    document_counts = {}
     for filename in os.listdir(directory):
-        if filename.endswith(".pdf"):
-            result_dict = {}
-            result_dict["_id"] = generate_object_id()
-            pdf_path = os.path.join(directory, filename)
-            text = ""
-            image_paths = []
-            assets = []  # To store the asset objects
-            print(f"Processing {filename}...")
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    page_text = page.extract_text()
-                    if page_text:
-                        # Find the position of "NEXT" and extract text up to that point
-                        pos = page_text.find("NEXT")
-                        if pos != -1:
-                            text += page_text[:pos]
-                            break
-                        text += page_text
-
-                    for img_num, img in enumerate(page.images):
-                        x0, y0, x1, y1 = img["x0"], img["top"], img["x1"], img["bottom"]
-                        cropped_image = page.within_bbox((x0, y0, x1, y1)).to_image()
-                        
-                        # Generate filename and save path
-                        img_filename = f"{filename}_image_page{page_num+1}_img{img_num+1}.png"
-                        img_path = os.path.join(image_dir, img_filename)
-                        
-                        # Save the cropped image locally
-                        cropped_image.save(img_path)
-                        image_paths.append(img_path)
-                        
-                        # Upload the image and get the URL and path in the Firebase bucket
-                        upload_result = upload_image_to_firebase(img_path, img_filename, result_dict["_id"])
-                        image_url = upload_result["url"]
-                        firebase_path = upload_result["path"]  # This is the path inside the Firebase bucket
-                        
-                        # Get the image size in bytes
-                        image_size = os.path.getsize(img_path)
-                        image_id = generate_object_id()
-                        
-                        # Add the image data into the assets list
-                        assets.append({
-                            "url": image_url,
-                            "path": firebase_path,  # Firebase bucket path
-                            "size": image_size,
-                            "_id": image_id
-                        })
-
-            without_top_content = remove_content_above_question(text)
-            # Remove consecutive duplicate words
-            no_duplicates_text = remove_consecutive_duplicates(without_top_content)
-
-            # Remove web links
-            final_text = remove_web_links(no_duplicates_text)
-            # print(final_text)
-
-            input_text = extract_question_data(final_text)
-            print("--------------------------input_text---------------------------")
-            print(input_text)
-            print("---------------------------------------------------------------")
-
-            j_consist_tables = False
-            q_consist_tables = False
-            complete = True
-
-            question, q_consist_tables, complete =list_tables_and_rephrase(input_text["question"], tabel_chain, rephrase_chain)
-            
-            result_dict['filename'] = filename
-            result_dict['question'] = question
-
-            for answer in input_text['answers']:
-                if 'explanation' in answer and answer['explanation']:
-                    # Rephrase the explanation and check for tables
-                    explanation, consist_tables, complete = list_tables_and_rephrase(answer['explanation'], tabel_chain, rephrase_chain)
-                    
-                    # Update the explanation in the answer
-                    answer['explanation'] = explanation
-                    answer['_id'] = generate_object_id()
-                    
-                    # Set flag if tables are found in the explanation
-                    if consist_tables:
-                        j_consist_tables = True
+        if not filename.endswith(".pdf"):
+            continue
+        hashes = set()
+        with pdfplumber.open(os.path.join(directory, filename)) as pdf:
+            for page in pdf.pages:
+                # Images dropped by their geometry never reach the blocklist
+                imgs = [img for img in page.images if image_filter.is_content_geometry(img, {})]
+                if imgs:
+                    hashes.update(perceptual_hash(data) for data in render_page_images(page, imgs))
+        for image_hash in hashes:
+            document_counts[image_hash] = document_counts.get(image_hash, 0) + 1
+
+    frequent = sorted(document_counts.items(), key=lambda item: item[1], reverse=True)
+    blocked_hashes = [image_hash for image_hash, count in frequent[:top_n] if count >= min_documents]
+    with open(output_path, 'w') as file:
+        json.dump(blocked_hashes, file, indent=4)
+    print(f"Saved {len(blocked_hashes)} decorative image hashes to {output_path}")
+    return blocked_hashes
+
+class ImageOptimizer:
+    """Downscales and re-encodes images to reduce their size.
+
+    Images are shrunk to fit max_width x max_height and encoded as PNG
+    (optimized), WebP or JPEG at the given quality. With lossless_only, images
+    are never downscaled, JPEGs are kept as they are and WebP is lossless.
+    The smaller of the original and the optimized image is kept.
+    """
+
+    EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg"}
+
+    def __init__(self, max_width=1600, max_height=1600, image_format="png", quality=85, lossless_only=False):
+        if image_format not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.max_size = (max_width, max_height)
+        self.format = image_format
+        self.quality = quality
+        self.lossless_only = lossless_only
+        if lossless_only and image_format == "jpeg":
+            self.format = "png"
+
+    def encode(self, image, image_format):
+        buffer = io.BytesIO()
+        if image_format == "png":
+            image.save(buffer, format="PNG", optimize=True)
+        elif image_format == "webp":
+            image.save(buffer, format="WEBP", lossless=self.lossless_only, quality=self.quality, method=6)
+        else:
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(buffer, format="JPEG", quality=self.quality, optimize=True)
+        return buffer.getvalue()
+
+    def optimize(self, image_data, extension):
+        """Returns (image bytes, extension, DOCX image bytes) for an encoded image."""
+        if self.lossless_only and extension == "jpg":
+            return image_data, extension, image_data
+        image = Image.open(io.BytesIO(image_data))
+        image.load()
+        original_size = image.size
+        if not self.lossless_only:
+            image.thumbnail(self.max_size)
+
+        optimized = self.encode(image, self.format)
+        optimized_extension = self.EXTENSIONS[self.format]
+        # Keep the original when re-encoding did not help and the image was not downscaled
+        if len(optimized) >= len(image_data) and image.size == original_size:
+            optimized, optimized_extension = image_data, extension
+
+        docx_image_data = optimized
+        if optimized_extension == "webp":
+            docx_image_data = self.encode(image, "png")
+        return optimized, optimized_extension, docx_image_data
+
+image_filter = ImageFilter(IMAGE_MIN_AREA, IMAGE_MAX_ASPECT_RATIO,
+                           load_decorative_hashes(DECORATIVE_HASHES_PATH), DECORATIVE_HASH_DISTANCE)
+image_optimizer = ImageOptimizer(IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT, IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_LOSSLESS_ONLY)
+
+def parse_pdf(pdf_path):
+    """Extracts the text and cropped images of a single PDF and parses the question data.
+
+    This is the CPU-bound stage of the pipeline. It only touches the local
+    filesystem, so it can safely run inside a worker process.
+
+    Args:
+        pdf_path: The path to the PDF file.
+
+    Returns:
+        A dict with the filename, the parsed question data and the cropped images.
+    """
+    filename = os.path.basename(pdf_path)
+    text = ""
+    images = []  # (img_filename, PNG bytes) for every cropped image
+    table_rows = None  # Table candidate rows, None when the detector is off
+    tables = None  # Geometric tables, None when the table engine is off
+    image_bytes_saved = 0
+    image_filter_hits = {}  # Skipped decorative images per reason
+    print(f"Processing {filename}...")
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_num, page in enumerate(pdf.pages):
+            page_text = page.extract_text()
+            if TABLE_PREFILTER:
+                table_rows = (table_rows or []) + table_detector.candidate_rows(page)
+            if TABLE_ENGINE:
+                tables = (tables or []) + table_engine.extract_tables(page)
+            if page_text:
+                # Find the position of "NEXT" and extract text up to that point
+                pos = page_text.find("NEXT")
+                if pos != -1:
+                    text += page_text[:pos]
+                    break
+                text += page_text
+
+            # Keep the position of every image in page.images, so filenames don't depend on the filter
+            page_images = list(enumerate(page.images))
+            if IMAGE_FILTER:
+                page_images = [(img_num, img) for img_num, img in page_images
+                               if image_filter.is_content_geometry(img, image_filter_hits)]
+            extracted = [None] * len(page_images)
+            if IMAGE_EXTRACTION == "embedded":
+                extracted = [extract_embedded_image(img) for _, img in page_images]
+            # Images that were not extracted from their stream are cropped from a render
+            to_render = [img for (_, img), image in zip(page_images, extracted) if image is None]
+            if to_render and RENDER_PAGE_ONCE:
+                rendered = iter(render_page_images(page, to_render, RENDER_DPI))
+            else:
+                rendered = (render_image(page, img, RENDER_DPI) for img in to_render)
+
+            for (img_num, _), image in zip(page_images, extracted):
+                # The image is encoded once; the bytes are shared by the upload, the size and the DOCX
+                if image is None:
+                    image = next(rendered), "png"
+                image_data, extension = image
+                if IMAGE_FILTER and image_filter.is_blocked(image_data, image_filter_hits):
+                    continue
+                # python-docx can't embed WebP, so the DOCX may get a PNG of the image
+                docx_image_data = image_data
+                if IMAGE_OPTIMIZE:
+                    original_bytes = len(image_data)
+                    image_data, extension, docx_image_data = image_optimizer.optimize(image_data, extension)
+                    image_bytes_saved += original_bytes - len(image_data)
+
+                # Generate filename
+                img_filename = f"{filename}_image_page{page_num+1}_img{img_num+1}.{extension}"
+                images.append((img_filename, image_data, docx_image_data))
+
+                if SAVE_IMAGES:
+                    os.makedirs(image_dir, exist_ok=True)
+                    with open(os.path.join(image_dir, img_filename), "wb") as file:
+                        file.write(image_data)
+
+    # Remove the content above the question, consecutive duplicate words and web links
+    normalization_hits = {}
+    final_text = text_normalizer.normalize(text, normalization_hits)
+    # print(final_text)
+
+    return {
+        "filename": filename,
+        "input_text": parse_question_data(final_text),
+        "images": images,
+        "normalization_hits": normalization_hits,
+        "table_rows": table_rows,
+        "tables": tables,
+        "image_bytes_saved": image_bytes_saved,
+        "image_filter_hits": image_filter_hits,
+    }
+
+def rephrase_parsed_pdf(parsed, image_uploader, manifest=None, pdf_path=None, pdf_hash=None):
+    """Starts the uploads of a parsed PDF and rephrases its text.
+
+    This is the I/O-bound stage of the pipeline; it is safe to run in several
+    threads. Returns the state store_processed_pdf needs to finish the PDF.
+    """
+    filename = parsed["filename"]
+    input_text = parsed["input_text"]
+    # Results of the stages completed by a previous run
+    resumed = {}
+    if manifest:
+        entry = manifest.get(pdf_hash)
+        if entry:
+            resumed = entry["payload"]
+            print(f"Resuming {filename} after stage {entry['stage']}")
+        else:
+            manifest.update(pdf_hash, pdf_path, "parsed")
+    result_dict = {}
+    # Every PDF holds a single question, at index 0
+    if MONGO_UPSERT:
+        result_dict["_id"] = generate_stable_object_id(BANK_NAME, pdf_hash, 0)
+    else:
+        result_dict["_id"] = generate_object_id()
+    images = []
+
+    # Start the uploads; they run while the text is rephrased
+    uploads = []
+    for img_filename, image_data, docx_image_data in parsed["images"]:
+        images.append(docx_image_data)
+        # Upload the image, or reuse the blob of an identical image
+        if "assets" not in resumed:
+            uploads.append(image_uploader.submit(image_data, img_filename, result_dict["_id"]))
+
+    print("--------------------------input_text---------------------------")
+    print(input_text)
+    print("---------------------------------------------------------------")
+
+    j_consist_tables = False
+    q_consist_tables = False
+
+    # The question first, then every non-empty explanation in answer order
+    explained_answers = [
+        (answer_index, answer) for answer_index, answer in enumerate(input_text['answers'])
+        if 'explanation' in answer and answer['explanation']
+    ]
+    texts = [input_text["question"]] + [answer['explanation'] for _, answer in explained_answers]
+    detect_tables = [True] * len(texts)
+    if parsed["table_rows"] is not None:
+        detect_tables = [may_contain_table(text, parsed["table_rows"]) for text in texts]
+    formatted = [False] * len(texts)
+    if parsed["tables"] is not None:
+        # Texts whose tables were all formatted from the geometry skip tabel_chain
+        texts, formatted, uncertain = apply_geometric_tables(texts, parsed["tables"])
+        detect_tables = [
+            uncertain[i] if formatted[i] else detect_tables[i] or uncertain[i]
+            for i in range(len(texts))
+        ]
+    if "results" in resumed:
+        results = [tuple(result) for result in resumed["results"]]
+    else:
+        choices = [answer_index + 1 for answer_index, _ in explained_answers]
+        results = rephrase_texts(texts, detect_tables, choices)
+        results = [
+            (content, tables_present or formatted[i], ok)
+            for i, (content, tables_present, ok) in enumerate(results)
+        ]
+    complete = all(result[2] for result in results)
+    if manifest and "results" not in resumed:
+        if complete:
+            manifest.update(pdf_hash, pdf_path, "rephrased", results=results)
+        else:
+            manifest.update(pdf_hash, pdf_path, error="rephrase incomplete")
+
+    question, q_consist_tables, _ = results[0]
+    
+    result_dict['filename'] = filename
+    result_dict['question'] = question
+
+    for (answer_index, answer), (explanation, consist_tables, _) in zip(explained_answers, results[1:]):
+        # Update the explanation in the answer
+        answer['explanation'] = explanation
+        if MONGO_UPSERT:
+            answer['_id'] = generate_stable_object_id(BANK_NAME, pdf_hash, 0, "answer", answer_index)
+        else:
+            answer['_id'] = generate_object_id()
         
-            result_dict['answers'] = input_text['answers']
-            result_dict['assets'] = assets
-
-            result_dict["bank"] = "CUSTOM"
-            result_dict["status"] = "AVAILABLE"
-            result_dict["addedBy"] = "SCRIPT"
-            result_dict["createdAt"] = get_current_timestamp()
-            result_dict["updatedAt"] = get_current_timestamp()
-
-            if(complete):
-                if q_consist_tables or j_consist_tables:
-                    result_dict['consist_tables'] = True
-                    append_content_to_docx(result_dict, image_paths, output_docx_with_tables)
-                    # append_json_to_file(result_dict, output_json_with_tables)
-                    collection.insert_one(result_dict)
-                else:
-                    result_dict['consist_tables'] = False
-                    append_content_to_docx(result_dict, image_paths, output_docx)
-                    # append_json_to_file(result_dict, output_json)
-                    collection.insert_one(result_dict)
+        # Set flag if tables are found in the explanation
+        if consist_tables:
+            j_consist_tables = True
+
+    return {
+        "parsed": parsed,
+        "result_dict": result_dict,
+        "images": images,
+        "uploads": uploads,
+        "resumed": resumed,
+        "complete": complete,
+        "consist_tables": q_consist_tables or j_consist_tables,
+        "pdf_path": pdf_path,
+        "pdf_hash": pdf_hash,
+    }
+
+def store_processed_pdf(processed, mongo_writer, docx_writer, jsonl_writer=None, manifest=None):
+    """Waits for the uploads of a rephrased PDF and writes its record to the outputs.
+
+    The writers are not thread-safe, so this stage runs in a single thread.
+    """
+    parsed = processed["parsed"]
+    filename = parsed["filename"]
+    input_text = parsed["input_text"]
+    result_dict = processed["result_dict"]
+    images = processed["images"]
+    resumed = processed["resumed"]
+    complete = processed["complete"]
+    pdf_path, pdf_hash = processed["pdf_path"], processed["pdf_hash"]
+    global image_bytes_saved
+    for rule_name, count in parsed["normalization_hits"].items():
+        normalization_hits[rule_name] = normalization_hits.get(rule_name, 0) + count
+    image_bytes_saved += parsed["image_bytes_saved"]
+    for reason, count in parsed["image_filter_hits"].items():
+        image_filter_hits[reason] = image_filter_hits.get(reason, 0) + count
+    assets = []  # To store the asset objects
+
+    uploaded = True
+    for upload in processed["uploads"]:
+        try:
+            upload_result = upload.result()
+        except Exception as e:
+            print(f"An unexpected error occurred while uploading images of {filename}: {e}.")
+            complete = False
+            uploaded = False
+            continue
+        image_url = upload_result["url"]
+        firebase_path = upload_result["path"]  # This is the path inside the Firebase bucket
+        image_size = upload_result["size"]
+        if MONGO_UPSERT:
+            image_id = generate_stable_object_id(BANK_NAME, pdf_hash, 0, "asset", len(assets))
+        else:
+            image_id = generate_object_id()
+
+        # Add the image data into the assets list
+        assets.append({
+            "url": image_url,
+            "path": firebase_path,  # Firebase bucket path
+            "size": image_size,
+            "_id": image_id
+        })
+
+    if "assets" in resumed:
+        # The manifest keeps the ObjectIds as strings
+        assets = [dict(asset, _id=ObjectId(asset["_id"])) for asset in resumed["assets"]]
+    elif manifest:
+        if not uploaded:
+            manifest.update(pdf_hash, pdf_path, error="upload failed")
+        elif complete:
+            manifest.update(pdf_hash, pdf_path, "uploaded", assets=assets)
+        else:
+            # The rephrase of this attempt failed; keep the uploads for the next one
+            manifest.update(pdf_hash, pdf_path, error="rephrase incomplete", assets=assets)
+
+    result_dict['answers'] = input_text['answers']
+    result_dict['assets'] = assets
+
+    result_dict["bank"] = BANK_NAME
+    result_dict["status"] = "AVAILABLE"
+    result_dict["addedBy"] = "SCRIPT"
+    result_dict["createdAt"] = get_current_timestamp()
+    result_dict["updatedAt"] = get_current_timestamp()
+
+    if(complete):
+        if processed["consist_tables"]:
+            result_dict['consist_tables'] = True
+            docx_writer.append(result_dict, images, output_docx_with_tables)
+            # append_json_to_file(result_dict, output_json_with_tables)
+            if jsonl_writer:
+                jsonl_writer.append(result_dict, output_jsonl_with_tables)
+        else:
+            result_dict['consist_tables'] = False
+            docx_writer.append(result_dict, images, output_docx)
+            # append_json_to_file(result_dict, output_json)
+            if jsonl_writer:
+                jsonl_writer.append(result_dict, output_jsonl)
+        if resumed.get("in_mongo"):
+            # A previous run inserted the record and stopped before its DOCX and
+            # JSONL records were saved; only those are written again
+            mongo_writer.skip(pdf_hash)
+        else:
+            mongo_writer.add(result_dict, pdf_hash)
+    else:
+        incomplete.append(filename)
+
+    print("--------------------------output_text---------------------------")
+    print(result_dict)
+    print("----------------------------------------------------------------")
+
+def process_parsed_pdf(parsed, mongo_writer, docx_writer, image_uploader, jsonl_writer=None,
+                       manifest=None, pdf_path=None, pdf_hash=None):
+    """Uploads the images, rephrases the text and stores the result of a parsed PDF.
+
+    With a manifest, every completed stage is recorded under pdf_hash and the
+    stages a previous run completed are not repeated.
+    """
+    processed = rephrase_parsed_pdf(parsed, image_uploader, manifest, pdf_path, pdf_hash)
+    store_processed_pdf(processed, mongo_writer, docx_writer, jsonl_writer, manifest)
+
+def try_parse_pdf(pdf_path):
+    """Returns the parsed PDF, or the exception that stopped its parsing."""
+    try:
+        return parse_pdf(pdf_path)
+    except Exception as e:
+        return e
+
+def record_failure(pdf_path, error, manifest=None, pdf_hash=None):
+    """Adds a PDF that could not be processed to the incomplete files."""
+    print(f"Failed to process {pdf_path}: {error}")
+    incomplete.append(os.path.basename(pdf_path))
+    if manifest:
+        manifest.update(pdf_hash, pdf_path, error=str(error))
+
+def parse_pool(workers):
+    """Returns a process pool for parse_pdf.
+
+    The writer and uploader threads are already running when the pool starts,
+    so its workers are started by a forkserver (spawn where that is missing)
+    instead of forking this process.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def parse_ahead(executor, pdf_paths, window):
+    """Parses PDFs in a process pool and yields (pdf_path, parsed PDF or exception) in input order.
+
+    At most window PDFs are submitted ahead of the one being yielded, so the
+    parsed PDFs and their image bytes do not pile up ahead of a slow consumer.
+    """
+    pending = collections.deque()
+    for pdf_path in pdf_paths:
+        pending.append((pdf_path, executor.submit(try_parse_pdf, pdf_path)))
+        if len(pending) >= window:
+            pdf_path, future = pending.popleft()
+            yield pdf_path, future.exception() or future.result()
+    for pdf_path, future in pending:
+        yield pdf_path, future.exception() or future.result()
+
+def run_pipeline(pdf_paths, pdf_hashes, mongo_writer, docx_writer, image_uploader, jsonl_writer=None,
+                 manifest=None, parse_workers=PARSE_WORKERS, llm_workers=LLM_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+    """Processes PDFs in stages connected by bounded queues.
+
+    The extraction stage parses PDFs in parse_workers processes, llm_workers
+    threads rephrase them, the ImageUploader threads upload their images and
+    the calling thread writes the records. A full queue blocks the stage that
+    feeds it, so at most queue_size PDFs wait between two stages. With more
+    than one LLM worker the records are written in completion order.
+
+    A PDF that fails to parse, rephrase or store is added to the incomplete files
+    and the run goes on.
+    """
+    parsed_queue = queue.Queue(queue_size)
+    processed_queue = queue.Queue(queue_size)
+    done = object()
+
+    # The pool is created here, before the stage threads start
+    executor = parse_pool(parse_workers) if parse_workers > 1 else None
+
+    def extract():
+        try:
+            if executor:
+                # Keep every worker busy without parsing further ahead than the queue allows
+                for item in parse_ahead(executor, pdf_paths, parse_workers):
+                    parsed_queue.put(item)
             else:
-                incomplete.append(filename)
+                for pdf_path in pdf_paths:
+                    parsed_queue.put((pdf_path, try_parse_pdf(pdf_path)))
+        finally:
+            for _ in range(llm_workers):
+                parsed_queue.put(done)
+
+    def rephrase():
+        while True:
+            item = parsed_queue.get()
+            if item is done:
+                processed_queue.put(done)
+                return
+            pdf_path, parsed = item
+            if not isinstance(parsed, Exception):
+                try:
+                    parsed = rephrase_parsed_pdf(parsed, image_uploader, manifest, pdf_path, pdf_hashes.get(pdf_path))
+                except Exception as e:
+                    parsed = e
+            processed_queue.put((pdf_path, parsed))
+
+    threads = [threading.Thread(target=extract, daemon=True)]
+    threads += [threading.Thread(target=rephrase, daemon=True) for _ in range(llm_workers)]
+    try:
+        for thread in threads:
+            thread.start()
+
+        running = llm_workers
+        while running:
+            item = processed_queue.get()
+            if item is done:
+                running -= 1
+                continue
+            pdf_path, processed = item
+            if isinstance(processed, Exception):
+                record_failure(pdf_path, processed, manifest, pdf_hashes.get(pdf_path))
+                continue
+            try:
+                store_processed_pdf(processed, mongo_writer, docx_writer, jsonl_writer, manifest)
+            except Exception as e:
+                record_failure(pdf_path, e, manifest, pdf_hashes.get(pdf_path))
+
+        for thread in threads:
+            thread.join()
+    finally:
+        # On an aborted run the stage threads are daemons blocked on the queues;
+        # the parse pool is shut down so its workers do not outlive the run
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+def extract_pdfs(directory, workers=PARSE_WORKERS, manifest_path=MANIFEST_PATH):
+    """Converts PDFs in a directory to a single JSON file.
+
+    Args:
+        directory: The path to the directory containing PDFs.
+        workers: Number of worker processes used to parse the PDFs. With 1 the
+            PDFs are parsed serially in this process.
+        manifest_path: The SQLite manifest of processed PDFs. PDFs it records as
+            stored are skipped; failed and partially processed ones are resumed.
+    """
+    pdf_paths = [
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.endswith(".pdf")
+    ]
+
+    manifest = Manifest(manifest_path) if manifest_path else None
+    pdf_hashes = {}
+    on_stored = None
+    if manifest or MONGO_UPSERT:
+        pdf_hashes = {pdf_path: hash_file(pdf_path) for pdf_path in pdf_paths}
+    if manifest:
+        skipped = [pdf_path for pdf_path in pdf_paths if manifest.is_stored(pdf_hashes[pdf_path])]
+        if skipped:
+            print(f"Skipping {len(skipped)} PDFs stored by a previous run")
+        pdf_paths = [pdf_path for pdf_path in pdf_paths if pdf_path not in skipped]
+        paths_by_hash = {pdf_hash: pdf_path for pdf_path, pdf_hash in pdf_hashes.items()}
+
+        # A PDF is stored once Mongo has it and its DOCX and JSONL records are
+        # on disk, so the PDFs Mongo reports wait for the next DOCX checkpoint.
+        # Mongo's success is recorded at once, so a rerun does not insert them again.
+        in_mongo = []
+        in_mongo_lock = threading.Lock()
+
+        def on_stored(pdf_hash, error):
+            if error is None:
+                manifest.update(pdf_hash, paths_by_hash[pdf_hash], in_mongo=True)
+                with in_mongo_lock:
+                    in_mongo.append(pdf_hash)
+            else:
+                manifest.update(pdf_hash, paths_by_hash[pdf_hash], error=error)
+
+        def mark_stored():
+            with in_mongo_lock:
+                stored = in_mongo[:]
+                in_mongo.clear()
+            for pdf_hash in stored:
+                manifest.update(pdf_hash, paths_by_hash[pdf_hash], "stored")
+
+    image_index = ImageIndex(IMAGE_INDEX_PATH)
+
+    def on_checkpoint():
+        # The JSONL records appended before the checkpoint are flushed with it
+        if jsonl_writer:
+            jsonl_writer.flush()
+        if manifest:
+            mark_stored()
+
+    # Records are written in batches and the documents are kept open;
+    # the writers flush what is left on exit
+    with MongoWriter(get_collection(), incomplete, MONGO_BATCH_SIZE, MONGO_FLUSH_SECONDS, on_stored,
+                     MONGO_UPSERT) as mongo_writer, \
+            DocxWriter(DOCX_CHECKPOINT_EVERY, on_checkpoint) as docx_writer, \
+            JsonlWriter(OUTPUT_JSONL_COMPRESSION) as jsonl_writer, \
+            ImageUploader(image_index, UPLOAD_WORKERS, UPLOAD_RETRIES, UPLOAD_BACKOFF_SECONDS) as image_uploader:
+        if not OUTPUT_JSONL:
+            jsonl_writer = None
+        if PIPELINE:
+            run_pipeline(pdf_paths, pdf_hashes, mongo_writer, docx_writer, image_uploader, jsonl_writer,
+                         manifest, workers, LLM_WORKERS, PIPELINE_QUEUE_SIZE)
+        else:
+            if workers > 1:
+                # Parse in worker processes; the results come in input order,
+                # so the output is the same as the serial path.
+                executor = parse_pool(workers)
+                parsed_pdfs = parse_ahead(executor, pdf_paths, workers)
+            else:
+                executor = None
+                parsed_pdfs = ((pdf_path, try_parse_pdf(pdf_path)) for pdf_path in pdf_paths)
+            try:
+                # A PDF that fails is added to the incomplete files and the run goes on
+                for pdf_path, parsed in parsed_pdfs:
+                    try:
+                        if isinstance(parsed, Exception):
+                            raise parsed
+                        process_parsed_pdf(parsed, mongo_writer, docx_writer, image_uploader, jsonl_writer,
+                                           manifest, pdf_path, pdf_hashes.get(pdf_path))
+                    except Exception as e:
+                        record_failure(pdf_path, e, manifest, pdf_hashes.get(pdf_path))
+            finally:
+                if executor:
+                    executor.shutdown(cancel_futures=True)
+    if manifest:
+        # The writers are closed, so the last PDFs Mongo reported are stored too
+        mark_stored()
 
-            print("--------------------------output_text---------------------------")
-            print(result_dict)
-            print("----------------------------------------------------------------")
     print("Incomplete files: ", incomplete)    
+    print("Normalization hits: ", normalization_hits)
+    print("Image dedup: ", image_index.stats())
+    if IMAGE_OPTIMIZE:
+        print("Image optimization saved bytes: ", image_bytes_saved)
+    if IMAGE_FILTER:
+        print("Decorative images skipped: ", image_filter_hits)
+    if llm_cache:
+        print("LLM cache: ", llm_cache.stats())
+    if rate_limiter:
+        print("LLM rate limiter: ", rate_limiter.stats())
+    if FUSED_LLM:
+        print("Fused LLM calls: ", dict(fused_stats))
+    if SPECULATIVE_REPHRASE:
+        print("Speculative rephrase: ", speculation_summary())
+    if BATCH_EXPLANATIONS:
+        print("Explanation batches: ", dict(batch_stats))
+    print("Duplicate texts rephrased once: ", duplicate_texts["texts"])
+    if manifest:
+        print("Manifest: ", manifest.stats())
 
     return
 
-extract_pdfs(pdf_directory)
\ No newline at end of file
+if __name__ == "__main__":
+    extract_pdfs(pdf_directory)
@@ -0,0 +1,38 @@
+import os
+import sys
+
+# The extractor reads its settings at import; keep the checks off the network and out of output/
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["IMAGE_INDEX_PATH"] = ""
+os.environ["MANIFEST_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None):
+        if self.bucket.failures:
+            self.bucket.failures -= 1
+            raise ConnectionError("upload failed")
+        self.bucket.blobs[self.name] = (bytes(data), content_type)
+
+    @property
+    def public_url(self):
+        return f"https://storage.test/{self.bucket.name}/{self.name}"
+
+
+class FakeBucket:
+    """In-memory stand-in for a google.cloud.storage bucket."""
+
+    def __init__(self, name="test-bucket", failures=0):
+        self.name = name
+        self.failures = failures  # Number of uploads that fail before the next one succeeds
+        self.blobs = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
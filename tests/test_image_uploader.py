@@ -0,0 +1,69 @@
+import pytest
+
+import regex_extractor_v02 as extractor
+from conftest import FakeBucket
+
+
+def upload(uploader, image_data, filename, question_id="q1"):
+    return uploader.submit(image_data, filename, question_id).result()
+
+
+def test_uploads_image_to_bucket():
+    bucket = FakeBucket()
+    with extractor.ImageUploader(extractor.ImageIndex(None), workers=2, bucket=bucket) as uploader:
+        result = upload(uploader, b"png-bytes", "a.png")
+
+    path = f"question-assets/{extractor.BANK_NAME}/q1/a.png"
+    assert bucket.blobs == {path: (b"png-bytes", "image/png")}
+    assert result == {"url": f"https://storage.test/test-bucket/{path}", "path": path, "size": 9}
+
+
+def test_identical_images_reuse_the_first_blob():
+    bucket = FakeBucket()
+    image_index = extractor.ImageIndex(None)
+    with extractor.ImageUploader(image_index, workers=2, bucket=bucket) as uploader:
+        first = upload(uploader, b"same", "a.png")
+        second = upload(uploader, b"same", "b.png", "q2")
+
+    assert len(bucket.blobs) == 1
+    assert second == first
+    assert image_index.stats() == {"hits": 1, "misses": 1, "bytes_saved": 4}
+
+
+def test_failed_upload_is_retried():
+    bucket = FakeBucket(failures=2)
+    with extractor.ImageUploader(extractor.ImageIndex(None), retries=3, backoff=0, bucket=bucket) as uploader:
+        upload(uploader, b"jpeg-bytes", "a.jpg")
+
+    assert list(bucket.blobs.values()) == [(b"jpeg-bytes", "image/jpeg")]
+
+
+def test_upload_error_is_raised_after_the_last_retry():
+    bucket = FakeBucket(failures=3)
+    with extractor.ImageUploader(extractor.ImageIndex(None), retries=3, backoff=0, bucket=bucket) as uploader:
+        with pytest.raises(ConnectionError):
+            upload(uploader, b"png-bytes", "a.png")
+
+    assert bucket.blobs == {}
+
+
+def test_zero_retries_still_uploads_once():
+    bucket = FakeBucket()
+    with extractor.ImageUploader(extractor.ImageIndex(None), retries=0, backoff=0, bucket=bucket) as uploader:
+        result = upload(uploader, b"png-bytes", "a.png")
+
+    assert len(bucket.blobs) == 1
+    assert result["size"] == 9
+
+
+def test_images_are_not_reused_across_buckets():
+    image_index = extractor.ImageIndex(None)
+    production, emulator = FakeBucket("production"), FakeBucket("emulator")
+    with extractor.ImageUploader(image_index, bucket=production) as uploader:
+        first = upload(uploader, b"same", "a.png")
+    with extractor.ImageUploader(image_index, bucket=emulator) as uploader:
+        second = upload(uploader, b"same", "a.png")
+
+    assert len(production.blobs) == len(emulator.blobs) == 1
+    assert first["url"].startswith("https://storage.test/production/")
+    assert second["url"].startswith("https://storage.test/emulator/")
@@ -0,0 +1,74 @@
+import time
+
+import mongomock
+from pymongo import UpdateOne
+
+import regex_extractor_v02 as extractor
+
+
+def make_writer(collection, **kwargs):
+    failed, stored = [], []
+    writer = extractor.MongoWriter(collection, failed, on_stored=lambda key, error: stored.append((key, error)),
+                                   **kwargs)
+    return writer, failed, stored
+
+
+def record(_id, filename):
+    return {"_id": _id, "filename": filename, "createdAt": "2024-01-01", "question": filename}
+
+
+def test_records_are_inserted_in_batches_and_on_close():
+    collection = mongomock.MongoClient().db.questions
+    writer, failed, stored = make_writer(collection, batch_size=2, flush_interval=60)
+    with writer:
+        for i in range(3):
+            writer.add(record(i, f"q{i}.pdf"), f"hash{i}")
+        # The first batch is full; the third record waits for close
+        assert collection.count_documents({}) == 2
+
+    assert collection.count_documents({}) == 3
+    assert writer.inserted == 3
+    assert failed == []
+    assert stored == [("hash0", None), ("hash1", None), ("hash2", None)]
+
+
+def test_buffer_is_flushed_after_the_flush_interval():
+    collection = mongomock.MongoClient().db.questions
+    writer, _, _ = make_writer(collection, batch_size=100, flush_interval=0.05)
+    with writer:
+        writer.add(record(1, "q1.pdf"))
+        time.sleep(0.3)
+        assert collection.count_documents({}) == 1
+
+
+def test_failed_inserts_are_reported_without_losing_the_batch():
+    collection = mongomock.MongoClient().db.questions
+    collection.insert_one(record(1, "old.pdf"))
+    writer, failed, stored = make_writer(collection, batch_size=10, flush_interval=60)
+    with writer:
+        writer.add(record(1, "q1.pdf"), "hash1")
+        writer.add(record(2, "q2.pdf"), "hash2")
+
+    assert collection.count_documents({}) == 2
+    assert failed == ["q1.pdf"]
+    assert stored[0][0] == "hash1" and stored[0][1]
+    assert stored[1] == ("hash2", None)
+
+
+def test_skipped_records_are_reported_stored_without_writing():
+    collection = mongomock.MongoClient().db.questions
+    writer, failed, stored = make_writer(collection, batch_size=10, flush_interval=60)
+    with writer:
+        writer.skip("hash1")
+
+    assert collection.count_documents({}) == 0
+    assert writer.inserted == 0
+    assert stored == [("hash1", None)]
+
+
+def test_upsert_keeps_created_at():
+    assert extractor.upsert_operation(record(1, "q1.pdf")) == UpdateOne(
+        {"_id": 1},
+        {"$set": {"filename": "q1.pdf", "question": "q1.pdf"}, "$setOnInsert": {"createdAt": "2024-01-01"}},
+        upsert=True,
+    )
@@ -0,0 +1,31 @@
+import regex_extractor_v02 as extractor
+
+PAGE_TEXT = """18. Question
+1 point(s)
+Which expression is valid (in C++)?
+1. a + b ✔
+2. (x)?
+3. f(a+b)?
+4. c++
+INCORRECT
+The correct answer is 1. Addition (a + b) is valid.
+(Choice 2) A lone (x)? is not valid.
+(Choices 3 & 4) Neither f(a+b)? nor c++ applies.
+"""
+
+
+def test_options_with_regex_characters_are_parsed_as_text():
+    assert extractor.parse_question_data(PAGE_TEXT) == {
+        "question": "Which expression is valid (in C++)?",
+        "answers": [
+            {"text": "a + b", "isCorrect": True, "explanation": "Addition (a + b) is valid."},
+            {"text": "(x)?", "isCorrect": False, "explanation": "A lone (x)? is not valid."},
+            {"text": "f(a+b)?", "isCorrect": False, "explanation": "Neither f(a+b)? nor c++ applies."},
+            {"text": "c++", "isCorrect": False, "explanation": "Neither f(a+b)? nor c++ applies."},
+        ],
+    }
+
+
+def test_points_are_removed_from_the_question():
+    data = extractor.parse_question_data(PAGE_TEXT.replace("Which", "2 point(s) Which"))
+    assert data["question"] == "Which expression is valid (in C++)?"
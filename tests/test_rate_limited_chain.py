@@ -0,0 +1,75 @@
+import httpx
+import openai
+import pytest
+
+import regex_extractor_v02 as extractor
+
+REQUEST = httpx.Request("POST", "https://api.openai.test/v1/chat/completions")
+
+
+def status_error(error_class, status_code):
+    response = httpx.Response(status_code, request=REQUEST)
+    return error_class("error", response=response, body=None)
+
+
+class FlakyChain:
+    """Raises the given errors in turn, then answers."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def invoke(self, inputs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "answer"
+
+
+def rate_limited(chain, retries=3):
+    limiter = extractor.RateLimiter(requests_per_minute=0, tokens_per_minute=0)
+    return extractor.RateLimitedChain(chain, limiter, extractor.rephraser_prompt_template, retries, backoff=0), limiter
+
+
+@pytest.mark.parametrize("error", [
+    openai.APIConnectionError(request=REQUEST),
+    openai.APITimeoutError(request=REQUEST),
+    status_error(openai.InternalServerError, 503),
+    status_error(openai.RateLimitError, 429),
+])
+def test_retries_transient_errors(error):
+    chain = FlakyChain([error, error])
+    wrapped, limiter = rate_limited(chain)
+
+    assert wrapped.invoke({"text": "text"}) == "answer"
+    assert chain.calls == 3
+    assert limiter.in_flight == 0
+
+
+def test_only_rate_limits_lower_the_concurrency():
+    wrapped, limiter = rate_limited(FlakyChain([openai.APIConnectionError(request=REQUEST)]))
+    wrapped.invoke({"text": "text"})
+    assert limiter.stats()["rate_limited"] == 0
+
+    wrapped, limiter = rate_limited(FlakyChain([status_error(openai.RateLimitError, 429)]))
+    wrapped.invoke({"text": "text"})
+    assert limiter.stats()["rate_limited"] == 1
+
+
+def test_gives_up_after_the_last_retry():
+    error = openai.APIConnectionError(request=REQUEST)
+    chain = FlakyChain([error] * 3)
+    wrapped, _ = rate_limited(chain, retries=2)
+
+    with pytest.raises(openai.APIConnectionError):
+        wrapped.invoke({"text": "text"})
+    assert chain.calls == 3
+
+
+def test_does_not_retry_client_errors():
+    chain = FlakyChain([status_error(openai.BadRequestError, 400)])
+    wrapped, _ = rate_limited(chain)
+
+    with pytest.raises(openai.BadRequestError):
+        wrapped.invoke({"text": "text"})
+    assert chain.calls == 1